@@ -0,0 +1,70 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+import os
+import sys
+import tempfile
+import time
+
+# make the plugin package importable when running from a source checkout
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from octoprint_filamentsensorsimplified import Filament_sensor_simplifiedPlugin
+from octoprint_filamentsensorsimplified.gpio import create_backend
+
+clock = getattr(time, "perf_counter", time.time)
+
+
+class StubSettings(object):
+    # minimal stand-in for octoprint.plugin.PluginSettings backed by plugin defaults
+    def __init__(self, defaults, overrides=None):
+        self._values = dict(defaults)
+        self._values.update(overrides or {})
+
+    def get(self, path, *args, **kwargs):
+        return self._values.get(path[0])
+
+    def get_int(self, path, *args, **kwargs):
+        value = self._values.get(path[0])
+        return None if value is None else int(value)
+
+    def get_boolean(self, path, *args, **kwargs):
+        return bool(self._values.get(path[0]))
+
+    def set(self, path, value, *args, **kwargs):
+        self._values[path[0]] = value
+
+    def global_get(self, path, *args, **kwargs):
+        return None
+
+
+def create_plugin(settings=None):
+    plugin = Filament_sensor_simplifiedPlugin()
+    plugin._identifier = "filamentsensorsimplified"
+    plugin._logger = logging.getLogger("octoprint.plugins.filamentsensorsimplified")
+    # event journal goes to a throwaway folder
+    plugin._data_folder = tempfile.mkdtemp(prefix="filamentsensorsimplified")
+    overrides = dict(gpio_backend="simulated")
+    overrides.update(settings or {})
+    plugin._settings = StubSettings(plugin.get_settings_defaults(), overrides)
+    plugin.initialize()
+    # backend is created up front so levels can be set before startup, the GPIO initializer keeps it
+    plugin.gpio = create_backend(plugin._settings.get(["gpio_backend"]))
+    return plugin
+
+
+class NullPluginManager(object):
+    def send_plugin_message(self, identifier, data):
+        pass
+
+
+# runs startup and waits for the GPIO initializer, returns seconds until GPIO was ready
+def start_plugin(plugin, timeout=5.0):
+    if getattr(plugin, "_plugin_manager", None) is None:
+        plugin._plugin_manager = NullPluginManager()
+    start = clock()
+    plugin.on_after_startup()
+    if not plugin.ready.wait(timeout) or not plugin.gpio_initialized:
+        raise RuntimeError("GPIO initialization did not finish")
+    return clock() - start
@@ -0,0 +1,84 @@
+# coding=utf-8
+# Measures layer index build time and lookup cost.
+#
+# usage: python benchmarks/bench_layer_index.py [gcode file] [--layers N] [--moves N]
+# without a file a synthetic print of N layers (default 300) with M extruding moves each (default 2000) and Z hops
+# on every travel is generated, then the index is built, stored and loaded from the cache and random file positions
+# are looked up
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import logging
+import os
+import random
+import shutil
+import tempfile
+
+from _support import clock
+from octoprint_filamentsensorsimplified.layers import LayerIndexCache, build_index
+
+
+def synthetic_gcode(path, layers, moves, layer_height=0.2):
+    rnd = random.Random(0)
+    with open(path, "w") as f:
+        f.write("G28 ; home\nG1 Z5 F3000\nG92 E0\n")
+        e = 0.0
+        for layer in range(1, layers + 1):
+            z = layer * layer_height
+            f.write(";LAYER:%d\nG1 Z%.3f F3000\n" % (layer - 1, z))
+            for move in range(moves):
+                if move % 200 == 0:
+                    # travel with retract and Z hop
+                    f.write("G1 E%.5f F2400\nG1 Z%.3f\nG0 X%.3f Y%.3f F9000\nG1 Z%.3f\nG1 E%.5f F2400\n"
+                            % (e - 1, z + 0.4, rnd.uniform(0, 200), rnd.uniform(0, 200), z, e))
+                e += 0.03
+                f.write("G1 X%.3f Y%.3f E%.5f\n" % (rnd.uniform(0, 200), rnd.uniform(0, 200), e))
+        f.write("M104 S0\nG1 Z%.3f\n" % (layers * layer_height + 10))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="layer index build time")
+    parser.add_argument("file", nargs="?", help="G-code file to index")
+    parser.add_argument("--layers", type=int, default=300, help="layers of synthetic G-code")
+    parser.add_argument("--moves", type=int, default=2000, help="extruding moves per layer of synthetic G-code")
+    parser.add_argument("--lookups", type=int, default=100000, help="number of file position lookups")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix="filamentsensorsimplified")
+    try:
+        path = args.file
+        if not path:
+            path = os.path.join(folder, "synthetic.gcode")
+            synthetic_gcode(path, args.layers, args.moves)
+        size = os.path.getsize(path)
+
+        start = clock()
+        index = build_index(path)
+        built = clock() - start
+
+        cache = LayerIndexCache(os.path.join(folder, "layers"), logging.getLogger("bench"))
+        cache.store("bench", index)
+        start = clock()
+        loaded = cache.load("bench")
+        load_time = clock() - start
+        assert list(loaded.offsets) == list(index.offsets)
+
+        positions = [random.randrange(size) for _ in range(args.lookups)]
+        start = clock()
+        for filepos in positions:
+            index.locate(filepos)
+        lookup_time = clock() - start
+
+        print("file size:      %.1f MB" % (size / 1e6))
+        print("layers:         %d" % len(index))
+        print("build:          %.1f ms (%.0f MB/s)" % (built * 1000, size / 1e6 / built))
+        print("cache load:     %.2f ms" % (load_time * 1000))
+        print("lookup:         %.2f us" % (lookup_time * 1e6 / args.lookups))
+        if len(index):
+            print("last layer:     %s" % index.locate(size))
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# coding=utf-8
+# Measures alert delivery through the notification dispatcher to a local webhook.
+#
+# usage: python benchmarks/bench_notifications.py [--alerts N] [--fail N] [--delay S] [--backoff S]
+# a local HTTP server answers the first --fail attempts of every alert with 503 and takes --delay seconds per request,
+# reported are the time notify blocks the caller, delivery latency including retries and the dispatcher counters
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from _support import clock
+from octoprint_filamentsensorsimplified.notifications import NotificationDispatcher, WebhookSink
+
+
+class WebhookServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def handler(fail, delay, attempts, delivered, lock):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            alert = json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8"))
+            time.sleep(delay)
+            with lock:
+                attempts[alert["seq"]] += 1
+                accepted = attempts[alert["seq"]] > fail
+                if accepted:
+                    delivered[alert["seq"]] = clock() - alert["queued"]
+            self.send_response(200 if accepted else 503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="alert delivery latency")
+    parser.add_argument("--alerts", type=int, default=100, help="number of alerts")
+    parser.add_argument("--fail", type=int, default=2, help="failed attempts of every alert before it is accepted")
+    parser.add_argument("--delay", type=float, default=0.01, help="seconds the webhook takes per request")
+    parser.add_argument("--backoff", type=float, default=0.05, help="seconds before the first retry")
+    args = parser.parse_args()
+
+    attempts = defaultdict(int)
+    delivered = {}
+    lock = threading.Lock()
+    server = WebhookServer(("127.0.0.1", 0), handler(args.fail, args.delay, attempts, delivered, lock))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    dispatcher = NotificationDispatcher(logging.getLogger("bench"), backoff=args.backoff, retries=args.fail + 2,
+                                        max_queue=args.alerts * 2)
+    dispatcher.sinks = (WebhookSink("http://127.0.0.1:%d/alert" % server.server_address[1], timeout=5),)
+    dispatcher.start()
+
+    blocked = []
+    for seq in range(args.alerts):
+        start = clock()
+        dispatcher.notify("runout-%d" % seq, dict(seq=seq, type="runout", sensor="Filament", queued=start))
+        blocked.append(clock() - start)
+    # every alert again, none of them may be delivered twice
+    for seq in range(args.alerts):
+        dispatcher.notify("runout-%d" % seq, dict(seq=seq, type="runout", sensor="Filament", queued=clock()))
+
+    deadline = clock() + 30
+    while clock() < deadline:
+        stats = dispatcher.stats()
+        if stats["sent"] + stats["failed"] >= args.alerts:
+            break
+        time.sleep(0.01)
+    stats = dispatcher.stats()
+    dispatcher.stop()
+    server.shutdown()
+
+    blocked.sort()
+    latencies = sorted(delivered.values())
+    print("alerts:             %d, %d failed attempts each" % (args.alerts, args.fail))
+    print("notify p50/max:     %.1f / %.1f us" % (blocked[len(blocked) // 2] * 1e6, blocked[-1] * 1e6))
+    if latencies:
+        print("delivery p50/max:   %.1f / %.1f ms" % (latencies[len(latencies) // 2] * 1000, latencies[-1] * 1000))
+    print("delivered:          %d of %d" % (len(latencies), args.alerts))
+    print("requests:           %d" % sum(attempts.values()))
+    print("dispatcher:         %s" % ", ".join("%s=%s" % item for item in sorted(stats.items())))
+
+
+if __name__ == "__main__":
+    main()
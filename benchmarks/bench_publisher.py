@@ -0,0 +1,104 @@
+# coding=utf-8
+# Measures the state publisher with local subscribers.
+#
+# usage: python benchmarks/bench_publisher.py [--address tcp:127.0.0.1:5599] [--subscribers N] [--records N]
+#                                             [--rate N]
+# N subscribers read records as they come, one more subscriber never reads, records are published at the given rate,
+# reported are the time publish blocks the caller, delivery latency to the reading subscribers and whether the
+# stalled subscriber was dropped
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from _support import clock
+from octoprint_filamentsensorsimplified.publisher import LENGTH, StatePublisher, parse_address
+
+
+def connect(address):
+    family, target = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(target)
+    return sock
+
+
+def receive(sock, count, latencies):
+    buffer = b""
+    received = 0
+    while received < count:
+        data = sock.recv(65536)
+        if not data:
+            break
+        buffer += data
+        while len(buffer) >= LENGTH.size:
+            size = LENGTH.unpack(buffer[:LENGTH.size])[0]
+            if len(buffer) < LENGTH.size + size:
+                break
+            record = json.loads(buffer[LENGTH.size:LENGTH.size + size].decode("utf-8"))
+            buffer = buffer[LENGTH.size + size:]
+            if "published" in record:
+                latencies.append(clock() - record["published"])
+                received += 1
+    sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="state publisher latency")
+    parser.add_argument("--address", help="publisher address, a unix socket in a temporary folder by default")
+    parser.add_argument("--subscribers", type=int, default=8, help="number of reading subscribers")
+    parser.add_argument("--records", type=int, default=10000, help="number of published records")
+    parser.add_argument("--rate", type=float, default=2000, help="published records per second")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix="filamentsensorsimplified")
+    address = args.address or "unix:%s" % os.path.join(folder, "state.sock")
+    publisher = StatePublisher(address, logging.getLogger("bench"))
+    publisher.start()
+
+    latencies = [[] for _ in range(args.subscribers)]
+    readers = []
+    for index in range(args.subscribers):
+        reader = threading.Thread(target=receive, args=(connect(address), args.records, latencies[index]))
+        reader.daemon = True
+        reader.start()
+        readers.append(reader)
+    stalled = connect(address)
+    time.sleep(0.2)
+
+    blocked = []
+    started = clock()
+    for seq in range(args.records):
+        delay = started + seq / args.rate - clock()
+        if delay > 0:
+            time.sleep(delay)
+        record = dict(seq=seq, type="removed", sensor="Filament", pin=7, present=False, job="bench.gcode")
+        start = clock()
+        record["published"] = start
+        publisher.publish(record)
+        blocked.append(clock() - start)
+    deadline = clock() + 10
+    for reader in readers:
+        reader.join(max(0, deadline - clock()))
+    stats = publisher.stats()
+    publisher.stop()
+    stalled.close()
+
+    blocked.sort()
+    delivered = sorted(latency for subscriber in latencies for latency in subscriber)
+    print("records:            %d to %d subscribers" % (args.records, args.subscribers))
+    print("publish p50/max:    %.1f / %.1f us" % (blocked[len(blocked) // 2] * 1e6, blocked[-1] * 1e6))
+    if delivered:
+        print("delivery p50/p99:   %.2f / %.2f ms" % (delivered[len(delivered) // 2] * 1000,
+                                                      delivered[int(len(delivered) * 0.99)] * 1000))
+    print("delivered:          %d of %d" % (len(delivered), args.records * args.subscribers))
+    print("stalled dropped:    %s" % bool(stats["dropped"]))
+
+
+if __name__ == "__main__":
+    main()
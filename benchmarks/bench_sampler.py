@@ -0,0 +1,57 @@
+# coding=utf-8
+# Measures cost and timing of the polling sampler used when edge detection is not available.
+#
+# usage: python benchmarks/bench_sampler.py [--rate HZ] [--sensors N] [--seconds S] [--toggle HZ]
+# the simulated GPIO backend refuses edge detection so all sensor pins are polled, the first sensor pin is toggled
+# at the given rate so level changes go through the edge worker, exit code is 1 when the sampler used more than
+# --max-cpu percent of one core
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import sys
+import time
+
+from _support import create_plugin, start_plugin
+
+# BOARD pins of the simulated sensors
+PINS = (7, 11, 13, 15, 29, 31, 33, 35)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="polling sampler cost")
+    parser.add_argument("--rate", type=float, default=100.0, help="polling passes per second")
+    parser.add_argument("--sensors", type=int, default=4, choices=range(1, len(PINS) + 1), metavar="N",
+                        help="number of polled sensors")
+    parser.add_argument("--seconds", type=float, default=10.0, help="duration of the measurement")
+    parser.add_argument("--toggle", type=float, default=1.0, help="level changes per second on the first pin")
+    parser.add_argument("--max-cpu", type=float, default=1.0, help="allowed CPU usage in percent")
+    args = parser.parse_args()
+
+    pins = PINS[:args.sensors]
+    sensors = [dict(pin=pin) for pin in pins[1:]]
+    plugin = create_plugin(dict(pin=pins[0], sensors=sensors, poll_rate=args.rate))
+    plugin.gpio.edge_detection = False
+    start_plugin(plugin)
+    if set(plugin.sampler.pins) != set(pins):
+        raise RuntimeError("pins %s are not polled" % (pins,))
+
+    gpio = plugin.gpio
+    level = 0
+    end = time.time() + args.seconds
+    while time.time() < end:
+        time.sleep(1.0 / args.toggle if args.toggle else args.seconds)
+        level = 1 - level
+        gpio.set_level(pins[0], level)
+    plugin.edge_worker.flush(5)
+    stats = plugin.sampler.stats()
+    stats["edge_evaluations"] = plugin.edge_worker.stats()["evaluations"]
+    plugin.on_shutdown()
+
+    print(json.dumps(stats, indent=2, sort_keys=True))
+    if stats["cpu_percent"] is not None and stats["cpu_percent"] > args.max_cpu:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
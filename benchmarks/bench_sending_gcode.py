@@ -0,0 +1,65 @@
+# coding=utf-8
+# Measures throughput of the sending_gcode hook.
+#
+# usage: python benchmarks/bench_sending_gcode.py [gcode file] [--lines N]
+# without a file a synthetic print of N (default 1 000 000) short G1 segments is generated
+from __future__ import absolute_import, print_function
+
+import argparse
+import random
+
+from _support import clock, create_plugin, start_plugin
+
+
+def synthetic_gcode(count):
+    rnd = random.Random(182)
+    lines = []
+    e = 0.0
+    for i in range(count):
+        if i % 5000 == 0:
+            lines.append("M105")
+        elif i % 997 == 0:
+            lines.append("M113 S2")
+        else:
+            e += 0.02
+            lines.append("G1 X%.3f Y%.3f E%.5f" % (rnd.uniform(0, 220), rnd.uniform(0, 220), e))
+    return lines
+
+
+def load_gcode(path):
+    lines = []
+    with open(path) as f:
+        for line in f:
+            line = line.split(";", 1)[0].strip()
+            if line:
+                lines.append(line)
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="sending_gcode hook throughput")
+    parser.add_argument("file", nargs="?", help="G-code file to stream through the hook")
+    parser.add_argument("--lines", type=int, default=1000000, help="number of synthetic lines")
+    args = parser.parse_args()
+
+    lines = load_gcode(args.file) if args.file else synthetic_gcode(args.lines)
+    commands = [(line, line.split(" ", 1)[0]) for line in lines]
+
+    plugin = create_plugin()
+    start_plugin(plugin)
+    hook = plugin.sending_gcode
+
+    start = clock()
+    for cmd, gcode in commands:
+        hook(None, "sending", cmd, None, gcode)
+    elapsed = clock() - start
+
+    print("lines:        %d" % len(commands))
+    print("elapsed:      %.3f s" % elapsed)
+    print("lines/s:      %.0f" % (len(commands) / elapsed))
+    print("ns per line:  %.1f" % (elapsed * 1e9 / len(commands)))
+    plugin.on_shutdown()
+
+
+if __name__ == "__main__":
+    main()
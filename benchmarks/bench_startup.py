@@ -0,0 +1,76 @@
+# coding=utf-8
+# Measures what the plugin adds to OctoPrint startup.
+#
+# usage: python benchmarks/bench_startup.py [--runs N] [--backend simulated|rpi]
+# import time of the plugin package is measured in a fresh interpreter for every run (OctoPrint and flask are imported
+# first as they are already loaded when OctoPrint loads plugins), then the time on_after_startup blocks the caller and
+# the time until the GPIO initializer has set up the sensors
+from __future__ import absolute_import, print_function
+
+import argparse
+import os
+import subprocess
+import sys
+
+from _support import NullPluginManager, clock, create_plugin
+
+IMPORT_SCRIPT = """
+import sys, time
+clock = getattr(time, "perf_counter", time.time)
+sys.path.insert(0, %r)
+import octoprint.plugin, flask
+start = clock()
+import octoprint_filamentsensorsimplified as plugin
+imported = clock()
+plugin.__plugin_check__()
+print("%%f %%f" %% (imported - start, clock() - imported))
+"""
+
+
+def measure_import():
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+    output = subprocess.check_output([sys.executable, "-c", IMPORT_SCRIPT % root])
+    imported, checked = output.decode("ascii").split()
+    return float(imported), float(checked)
+
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="plugin startup cost")
+    parser.add_argument("--runs", type=int, default=5, help="number of measurements")
+    parser.add_argument("--backend", default="simulated", help="GPIO backend to initialize")
+    args = parser.parse_args()
+
+    imports = []
+    checks = []
+    startups = []
+    readies = []
+    for _ in range(args.runs):
+        imported, checked = measure_import()
+        imports.append(imported)
+        checks.append(checked)
+
+        plugin = create_plugin(dict(pin=7, gpio_backend=args.backend))
+        # backend is created by the initializer like in OctoPrint
+        plugin.gpio = None
+        plugin._plugin_manager = NullPluginManager()
+        start = clock()
+        plugin.on_after_startup()
+        startups.append(clock() - start)
+        if not plugin.ready.wait(5) or not plugin.gpio_initialized:
+            raise RuntimeError("GPIO initialization did not finish")
+        readies.append(plugin.ready_time)
+        plugin.on_shutdown()
+
+    print("runs:                  %d" % args.runs)
+    print("import:                %.2f ms" % (median(imports) * 1000))
+    print("plugin check:          %.2f ms" % (median(checks) * 1000))
+    print("on_after_startup:      %.2f ms" % (median(startups) * 1000))
+    print("time to ready:         %.2f ms" % (median(readies) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+# coding=utf-8
+# Replays an OctoPrint serial.log through the plugin's comm hooks and measures their overhead.
+#
+# usage: python benchmarks/replay_serial_log.py serial.log [--edge LINE:LEVEL ...] [--expect-runout LINE ...]
+#                                                         [--pause-lines N] [--expect-recovery LINE ...]
+#        python benchmarks/replay_serial_log.py --synthetic 100000 --edge 50000:1 --expect-runout 50000
+#        python benchmarks/replay_serial_log.py --synthetic 20000 --edge 10000:1 --edge 10100:0 --pause-lines 200 \
+#                                               --expect-runout 10000 --expect-recovery 10201
+#
+# Sent lines go through queuing_gcode and sending_gcode, received lines through gcode_response_received. Sensor edges
+# are injected through the simulated GPIO backend when the given log line is reached, level 1 means no filament with
+# the default sensor setup. Commands the plugin queues on the printer are sent before the next log line, like
+# OctoPrint would. With --pause-lines the firmware is emulated to pause for user after the runout command for given
+# number of log lines, sent lines of the log are held back meanwhile. With --dispatch inject the runout command is
+# injected by the queuing hook ahead of the next line instead of being queued. Like OctoPrint, only the queuing hook
+# may turn a line into more, the replay fails if the sending hook tries. Results are printed as JSON, exit code is 1
+# when the runout command or the end of the filament change (recovery) isn't seen at exactly the expected lines.
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import re
+import time
+from datetime import datetime
+from array import array
+
+from _support import clock, create_plugin, start_plugin
+from octoprint.events import Events
+
+# N123 G1 X10*45 -> G1 X10
+line_number_checksum = re.compile(r"^N\d+\s+(.*?)(\*\d+)?$")
+# 2023-01-31 12:00:00,123 - Send: ...
+log_timestamp = re.compile(r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3})")
+
+
+class StubPrinter(object):
+    def __init__(self):
+        self.queued = []
+        self.paused = []
+        self.cancelled = []
+        self.held = []
+        self.on_hold = 0
+        self.line = 0
+
+    def commands(self, commands, *args, **kwargs):
+        if not isinstance(commands, (list, tuple)):
+            commands = [commands]
+        self.queued.extend(commands)
+
+    def pause_print(self, *args, **kwargs):
+        self.paused.append(self.line)
+
+    def cancel_print(self, *args, **kwargs):
+        self.cancelled.append(self.line)
+
+    def set_job_on_hold(self, value, *args, **kwargs):
+        self.on_hold += 1 if value else -1
+        if value:
+            self.held.append(self.line)
+
+    def get_current_data(self):
+        return dict(progress=dict(filepos=None))
+
+
+class StubPluginManager(object):
+    def __init__(self, printer):
+        self.printer = printer
+        self.messages = []
+
+    def send_plugin_message(self, identifier, data):
+        self.messages.append(dict(line=self.printer.line, data=data))
+
+
+# returns (kind, payload, seconds since the first line), lines without timestamp get the one of the line before
+def parse_log(path):
+    entries = []
+    first = None
+    seconds = 0.0
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+            match = log_timestamp.match(line)
+            if match:
+                timestamp = datetime.strptime(match.group(1), "%Y-%m-%d %H:%M:%S")
+                timestamp = time.mktime(timestamp.timetuple()) + int(match.group(2)) / 1000.0
+                if first is None:
+                    first = timestamp
+                seconds = timestamp - first
+            for marker, kind in ((" - Send: ", "send"), (" - Recv: ", "recv"), ("Send: ", "send"), ("Recv: ", "recv")):
+                index = line.find(marker)
+                if index != -1:
+                    payload = line[index + len(marker):]
+                    if kind == "send":
+                        match = line_number_checksum.match(payload)
+                        if match:
+                            payload = match.group(1)
+                    entries.append((kind, payload, seconds))
+                    break
+            else:
+                entries.append((None, line, seconds))
+    return entries
+
+
+def synthetic_log(count, line_time):
+    entries = []
+    e = 0.0
+    for i in range(count):
+        if i % 2:
+            entries.append(("recv", "ok", i * line_time))
+        else:
+            e += 0.02
+            entries.append(("send", "G1 X%.3f Y%.3f E%.5f" % (i % 200, (i * 7) % 200, e), i * line_time))
+    return entries
+
+
+def percentiles(samples):
+    if not samples:
+        return dict(count=0, p50_us=None, p99_us=None, max_us=None)
+    ordered = sorted(samples)
+    count = len(ordered)
+    return dict(count=count,
+                p50_us=ordered[int(count * 0.5)] * 1e6,
+                p99_us=ordered[min(count - 1, int(count * 0.99))] * 1e6,
+                max_us=ordered[-1] * 1e6)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay serial log through the plugin hooks")
+    parser.add_argument("log", nargs="?", help="OctoPrint serial.log")
+    parser.add_argument("--synthetic", type=int, metavar="LINES", help="use synthetic log instead of a file")
+    parser.add_argument("--line-time", type=float, default=0.01, metavar="SECONDS",
+                        help="time between lines of the synthetic log")
+    parser.add_argument("--pin", type=int, default=7, help="sensor pin (BOARD numbering)")
+    parser.add_argument("--edge", action="append", default=[], metavar="LINE:LEVEL",
+                        help="set sensor pin level when the log line is reached")
+    parser.add_argument("--expect-runout", action="append", type=int, default=[], metavar="LINE",
+                        help="log line at which the runout command is expected to be sent")
+    parser.add_argument("--expect-recovery", action="append", type=int, default=[], metavar="LINE",
+                        help="log line at which the filament change is expected to end after the printer resumed")
+    parser.add_argument("--pause-lines", type=int, default=0, metavar="LINES",
+                        help="emulate firmware pausing for user after the runout command")
+    parser.add_argument("--dispatch", choices=("queue", "inject"), default="queue",
+                        help="how the runout command is sent")
+    parser.add_argument("--output", help="write JSON result to this file")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        entries = synthetic_log(args.synthetic, args.line_time)
+    elif args.log:
+        entries = parse_log(args.log)
+    else:
+        parser.error("serial log or --synthetic required")
+
+    edges = {}
+    for edge in args.edge:
+        line, level = edge.split(":")
+        edges.setdefault(int(line), []).append(int(level))
+
+    printer = StubPrinter()
+    plugin_manager = StubPluginManager(printer)
+    plugin = create_plugin(dict(pin=args.pin, runout_dispatch=args.dispatch))
+    plugin._printer = printer
+    plugin._plugin_manager = plugin_manager
+    gpio = plugin.gpio
+    # filament present at start
+    gpio.set_level(args.pin, 0)
+    start_plugin(plugin)
+    plugin.on_event(Events.PRINT_STARTED, dict())
+    plugin_manager.messages = []
+
+    queuing = plugin.queuing_gcode
+    sending = plugin.sending_gcode
+    received = plugin.gcode_response_received
+    runout_gcode = plugin.config.primary.gcode
+    send_times = array("d")
+    recv_times = array("d")
+    events = []
+    pause_until = None
+    job_tags = frozenset(("source:file",))
+    api_tags = frozenset(("source:api",))
+
+    # returns lines actually sent, the queuing hook can send other lines before the given one
+    def send(cmd, tags):
+        result = queuing(None, "queuing", cmd, None, cmd.split(" ", 1)[0], tags=tags)
+        queued = [cmd]
+        if isinstance(result, list):
+            queued = [entry if isinstance(entry, str) else entry[0] for entry in result]
+        elif isinstance(result, tuple):
+            queued = [] if result[0] is None else [result[0]]
+        for line in queued:
+            start = clock()
+            result = sending(None, "sending", line, None, line.split(" ", 1)[0], tags=tags)
+            send_times.append(clock() - start)
+            if isinstance(result, list):
+                raise RuntimeError("sending hook returned %d lines for %s, OctoPrint allows that only while queuing"
+                                   % (len(result), line))
+            if line == runout_gcode:
+                events.append(dict(line=printer.line, event="runout_command_sent"))
+        return queued
+
+    def receive(line):
+        start = clock()
+        received(None, line)
+        recv_times.append(clock() - start)
+
+    started = clock()
+    for index, (kind, payload, seconds) in enumerate(entries):
+        printer.line = index + 1
+        for level in edges.get(printer.line, ()):
+            # time of the log line, so GPIO bounce time filtering sees edges as far apart as they were
+            gpio.set_level(args.pin, level, at=seconds)
+            plugin.edge_worker.flush(5)
+            events.append(dict(line=printer.line, event="edge", level=level))
+
+        initiated = plugin.filament_change.initiated
+        while printer.queued:
+            cmd = printer.queued.pop(0)
+            events.append(dict(line=printer.line, event="command_queued", command=cmd))
+            if runout_gcode in send(cmd, api_tags) and args.pause_lines:
+                pause_until = printer.line + args.pause_lines
+                receive("echo:busy: paused for user")
+
+        if pause_until is not None:
+            if printer.line < pause_until:
+                continue
+            pause_until = None
+            receive("echo:busy: processing")
+            receive("ok")
+
+        if kind == "send":
+            if runout_gcode in send(payload, job_tags) and args.pause_lines:
+                pause_until = printer.line + args.pause_lines
+                receive("echo:busy: paused for user")
+        elif kind == "recv":
+            receive(payload)
+
+        if initiated and not plugin.filament_change.initiated:
+            events.append(dict(line=printer.line, event="filament_change_ended"))
+    elapsed = clock() - started
+    plugin.on_shutdown()
+
+    runouts = [event["line"] for event in events if event["event"] == "runout_command_sent"]
+    recoveries = [event["line"] for event in events if event["event"] == "filament_change_ended"]
+    hook_calls = len(send_times) + len(recv_times)
+    result = dict(
+        lines=len(entries),
+        elapsed_s=elapsed,
+        lines_per_s=len(entries) / elapsed if elapsed else None,
+        hook_calls_per_s=hook_calls / elapsed if elapsed else None,
+        sending_gcode=percentiles(send_times),
+        gcode_response_received=percentiles(recv_times),
+        events=events,
+        messages=plugin_manager.messages,
+        paused_at=printer.paused,
+        cancelled_at=printer.cancelled,
+        held_at=printer.held,
+        left_on_hold=printer.on_hold,
+        edge_worker=plugin.edge_worker.stats(),
+        runouts=plugin.filament_change.recent_traces(),
+        expectations=dict(runout_sent=dict(expected=args.expect_runout, actual=runouts,
+                                           ok=not args.expect_runout or runouts == args.expect_runout),
+                          recovered=dict(expected=args.expect_recovery, actual=recoveries,
+                                         ok=not args.expect_recovery or recoveries == args.expect_recovery)),
+    )
+
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    return 0 if all(expectation["ok"] for expectation in result["expectations"].values()) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
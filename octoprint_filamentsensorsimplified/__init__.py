@@ -2,14 +2,38 @@
 from __future__ import absolute_import
 
 import octoprint.plugin
-import re
 from octoprint.events import Events
+from octoprint.filemanager import FileDestinations
 from time import sleep
-import RPi.GPIO as GPIO
+import os
+import socket
+import threading
+import time
 import flask
 
+from .adaptive import AdaptiveFilter
+from .config import PluginConfig, SENSOR_MOTION, DISPATCH_INJECT
+from .debounce import Debouncer, monotonic
+from .edges import EdgeWorker
+from .filament_change import FilamentChange, STATE_NAMES, PAUSED_FOR_USER, QUEUED, HOST_PAUSED, SENT, PAUSED, \
+    PROCESSING, LINE_SENT
+from .gate import JobGate, OPEN, HELD, STATE_NAMES as GATE_STATE_NAMES, is_job_line
+from .gpio import candidate_pins, create_backend, module_available
+from .history import EventHistory, RUNOUT, JAM, REMOVED, INSERTED, BOUNCE, RECOVERED, PRINT_CANCELLED
+from .gcode import ExtrusionTracker, split_commands, FILAMENT_CHANGE_PREFIX, RUNOUT_COMMAND, FILAMENT_CHANGE, KEEPALIVE
+from .layers import LayerIndexer
+from .messages import MessageBroadcaster
+from .metrics import Metrics, render_gauge
+from .notifications import NotificationDispatcher, WebhookSink, CommandSink, MqttSink
+from .publisher import StatePublisher
+from .sampler import PollingSampler
+from .sdcard import SdPrintTracker, SD_PREFIXES, STARTED as SD_STARTED, ADVANCED as SD_ADVANCED, DONE as SD_DONE, \
+    STOPPED as SD_STOPPED
+from .sensors import MotionMonitor, SensorState, StatusCache, sensor_status
+
 
 class Filament_sensor_simplifiedPlugin(octoprint.plugin.StartupPlugin,
+                                       octoprint.plugin.ShutdownPlugin,
                                        octoprint.plugin.EventHandlerPlugin,
                                        octoprint.plugin.TemplatePlugin,
                                        octoprint.plugin.SettingsPlugin,
@@ -19,6 +43,24 @@ class Filament_sensor_simplifiedPlugin(octoprint.plugin.StartupPlugin,
     # bounce time for sensing
     bounce_time = 250
 
+    # maximum number of edges waiting for evaluation
+    edge_queue_size = 64
+
+    # seconds to wait for more edges of a burst before evaluating them
+    edge_coalesce_time = 0.01
+
+    # only every n-th call of the G-code hooks is timed for the metrics, timing costs more than the hook itself
+    hook_timing_interval = 64
+
+    # seconds after which runout command waiting for injection is queued on printer, when no line was sent meanwhile
+    injection_timeout = 2.0
+
+    # maximum number of events on one page of the history route
+    history_page_limit = 500
+
+    # tags of injected runout command lines
+    injection_tags = frozenset(("plugin:filamentsensorsimplified", "filamentsensorsimplified:runout"))
+
     # default gcode
     default_gcode = 'M600 X0 Y0'
 
@@ -28,44 +70,92 @@ class Filament_sensor_simplifiedPlugin(octoprint.plugin.StartupPlugin,
     # printing flag
     printing = False
 
+    # name of the file being printed, recorded with sensor events
+    job_name = None
+
+    # layer, Z and file position of the last runout, shown in the runout popup
+    runout_location = None
+
+    # print from SD card was detected from status reports without OctoPrint print events
+    sd_printing = False
+
+    # set by the background initializer when GPIO is set up, hooks and events do nothing with GPIO before
     gpio_initialized = False
 
+    # seconds from on_after_startup until GPIO was ready
+    ready_time = None
+
+    # seconds to wait for GPIO initialization in requests which need GPIO
+    ready_timeout = 10.0
+
+    # events sent as alerts to the notification sinks, with the alert message
+    notified_events = {RUNOUT: "Printer ran out of filament!", JAM: "Filament jammed!",
+                       PRINT_CANCELLED: "No filament detected! Print not started."}
+
+    # name of the printer in alerts, OctoPrint instance name or host name
+    printer_name = None
+
     def initialize(self):
-        GPIO.setwarnings(True)
-        # flag defining that the filament change command has been sent to printer, this does not however mean that
-        # filament change sequence has been started
-        self.changing_filament_initiated = False
-        # flag defining that the filament change sequence has been started and the M600 command has been se to printer
-        self.changing_filament_command_sent = False
-        # flag defining that the filament change sequence has been started and the printer is waiting for user
-        # to put in new filament
-        self.paused_for_user = False
-        # flag to prevent double detection
-        self.changing_filament_started = False
-
-    @property
-    def setting_gpio_mode(self):
-        return int(self._settings.get(["gpio_mode"]))
-
-    @property
-    def setting_pin(self):
-        return int(self._settings.get(["pin"]))
-
-    @property
-    def setting_power(self):
-        return int(self._settings.get(["power"]))
-
-    @property
-    def setting_gcode(self):
-        return self._settings.get(["g_code"])
-
-    @property
-    def setting_triggered(self):
-        return int(self._settings.get(["triggered"]))
-
-    @property
-    def setting_cmd_action(self):
-        return int(self._settings.get(["cmd_action"]))
+        # GPIO access goes through backend selected in settings, it is created on the initializer thread so that
+        # RPi.GPIO is imported and set up without holding up OctoPrint startup
+        self.gpio = None
+        # serializes GPIO setup between the initializer, settings save and API
+        self.gpio_lock = threading.RLock()
+        self.ready = threading.Event()
+        # state of filament change from runout detection to printer resuming, changed by the edge worker, comm and
+        # event threads through its transitions only
+        self.filament_change = FilamentChange(self._logger)
+        # decides from cached sensor states whether a print job may send its first line
+        self.job_gate = JobGate()
+        # SD card print followed from firmware status reports
+        self.sd_tracker = SdPrintTracker()
+        # counters served by the /metrics route, safe to update from any thread
+        self.metrics = Metrics()
+        # all plugin messages go through it, drops repeats and rate limits each message type
+        self.messages = MessageBroadcaster(self.deliver_message, self._logger)
+        # calls left until the next timed call of each G-code hook, each written only by the comm thread
+        self.sending_countdown = self.hook_timing_interval
+        self.received_countdown = self.hook_timing_interval
+        # pins with registered edge detection
+        self.detected_pins = set()
+        self.sensor_states = dict()
+        # expected filament movement for motion sensors, fed from sent lines
+        self.extrusion_tracker = ExtrusionTracker()
+        self.motion_monitors = dict()
+        # status of all sensors as last known, answers clients without reading GPIO
+        self.status_cache = StatusCache()
+        # sensor events in memory and in a journal in the plugin data folder
+        self.history = EventHistory(self.get_plugin_data_folder(), self._logger)
+        # pushes sensor events to local subscribers, None if not configured
+        self.publisher = None
+        # sends runout alerts to configured webhook, command and MQTT topic on its own threads
+        self.notifications = NotificationDispatcher(self._logger)
+        # layer index of the printed file, built in the background at print start to locate runouts
+        self.layer_indexer = LayerIndexer(os.path.join(self.get_plugin_data_folder(), "layers"), self._logger)
+        # polls pins on which edge detection can't be enabled, level changes go the same way as edges
+        self.sampler = PollingSampler(lambda pins: self.gpio.input_many(pins), self.sensor_callback, self._logger,
+                                      jitter=self.metrics.sampler_jitter)
+        self.load_config()
+        # sensor reads and reactions run on this worker instead of the GPIO callback thread
+        self.edge_worker = EdgeWorker(self.handle_edges, self._logger, self.edge_queue_size, self.edge_coalesce_time)
+
+    # snapshot of settings read by all code paths, replaced as a whole when settings change so that other threads
+    # never see a half-updated combination of values
+    def load_config(self):
+        config = PluginConfig.from_settings(self._settings)
+        # keep state of sensors whose pin didn't change
+        states = self.sensor_states
+        self.sensor_states = dict((pin, states.get(pin) or SensorState(pin)) for pin in config.by_pin)
+        self.motion_monitors = dict((sensor.pin, MotionMonitor(sensor.pin, sensor.motion_window,
+                                                               sensor.motion_pulses_per_mm))
+                                    for sensor in config.motion_sensors)
+        # tuning starts again from the configured values whenever settings change
+        bounds = config.filter_bounds
+        self.filters = dict((sensor.pin, AdaptiveFilter(sensor.pin, sensor.debouncer, self.bounce_time, bounds))
+                            for sensor in config.switch_sensors) if bounds is not None else dict()
+        self.sampler.rate = config.poll_rate
+        self.config = config
+        self.publish_status()
 
     # AssetPlugin hook
     def get_assets(self):
@@ -78,86 +168,552 @@ class Filament_sensor_simplifiedPlugin(octoprint.plugin.StartupPlugin,
     # Settings hook
     def get_settings_defaults(self):
         return dict(
+            gpio_backend="rpi",
             gpio_mode=10,
             pin=0,  # Default is 0
             power=0,
             g_code=self.default_gcode,
             triggered=0,
-            cmd_action=0
+            cmd_action=0,
+            # queue - runout g-code is queued behind commands waiting to be sent, inject - runout g-code is put
+            # into the send queue ahead of the next line entering it (usually the next line of the print job), it
+            # doesn't skip lines already in the send queue
+            runout_dispatch="queue",
+            # debouncing of sensor reads, intervals in milliseconds
+            debounce_mode="stable",
+            debounce_samples=50,
+            debounce_required=10,
+            debounce_interval=0,
+            debounce_deadline=100,
+            # motion sensors report jam if there are less pulses per mm than motion_pulses_per_mm over motion_window
+            # mm of extrusion
+            motion_window=20,
+            motion_pulses_per_mm=0.1,
+            # tune bounce time (ms) and required reads of switch sensors from observed noise within the bounds
+            adaptive_filter=False,
+            bounce_time_min=20,
+            bounce_time_max=1000,
+            debounce_required_min=3,
+            debounce_required_max=200,
+            # passes per second of polling pins on which edge detection can't be enabled
+            poll_rate=100,
+            # seconds between SD status reports the firmware is asked for if it can report by itself, 0 leaves
+            # SD status polling to OctoPrint
+            sd_status_interval=2,
+            # unix:<path> or tcp:<host>:<port> on which sensor state changes are published, empty disables it
+            publish_address="",
+            # tcp publish address may be other than loopback, subscribers from other hosts can connect then
+            publish_remote=False,
+            # runout alerts, JSON of the event is posted to the URL, given to the command on standard input and
+            # published to the MQTT topic (needs the MQTT plugin), empty disables each of them
+            notify_webhook_url="",
+            notify_command="",
+            notify_mqtt_topic="",
+            # seconds a single delivery may take and retries of failed deliveries, with doubling delay
+            notify_timeout=10,
+            notify_retries=5,
+            # additional sensors, list of dicts with name, type (switch or motion), pin, power, triggered, g_code and
+            # optionally debounce_* and motion_* settings, missing values are taken from the settings above
+            sensors=[]
         )
 
     # simpleApiPlugin
     def get_api_commands(self):
-        return dict(testSensor=["pin", "power"])
+        return dict(testSensor=["pin", "power"], scanPins=["mode"])
 
     @octoprint.plugin.BlueprintPlugin.route("/disable", methods=["GET"])
     def get_disable(self):
         self._logger.debug("getting gpio disabled by other plugins info")
         gpio_mode_disabled = self.gpio_mode_disabled
-        return flask.jsonify(gpio_mode_disabled=gpio_mode_disabled, printing=self.printing)
-
-    # test pin value, power pin or if its used by someone else
+        return flask.jsonify(gpio_mode_disabled=gpio_mode_disabled, printing=self.printing,
+                             sensors=self.status_cache.status["sensors"])
+
+    # last known sensor status, clients send the ETag back in If-None-Match and get 304 while nothing changed
+    @octoprint.plugin.BlueprintPlugin.route("/status", methods=["GET"])
+    def get_status(self):
+        status = self.status_cache.status
+        etag = self.status_cache.etag(status)
+        if flask.request.headers.get("If-None-Match") == etag:
+            response = flask.make_response("", 304)
+        else:
+            response = flask.make_response(flask.jsonify(status))
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    # latencies of recent filament changes
+    @octoprint.plugin.BlueprintPlugin.route("/runouts", methods=["GET"])
+    def get_runouts(self):
+        return flask.jsonify(state=self.filament_change.state_name, runouts=self.filament_change.recent_traces())
+
+    # Prometheus text format, built only from counters and last known states, a scrape never reads GPIO
+    @octoprint.plugin.BlueprintPlugin.route("/metrics", methods=["GET"])
+    def get_metrics(self):
+        return flask.Response("\n".join(self.render_metrics()) + "\n", mimetype="text/plain; version=0.0.4")
+
+    def render_metrics(self):
+        prefix = Metrics.prefix
+        lines = []
+        edges = self.edge_worker.stats()
+        render_gauge(lines, prefix + "edges_received_total", "Edges received from GPIO",
+                     [(None, edges["received"])], "counter")
+        render_gauge(lines, prefix + "edges_coalesced_total", "Edges merged into an evaluation of an earlier edge",
+                     [(None, edges["coalesced"])], "counter")
+        render_gauge(lines, prefix + "edges_overflows_total", "Edges which didn't fit into the edge queue",
+                     [(None, edges["overflows"])], "counter")
+        render_gauge(lines, prefix + "edge_evaluations_total", "Sensor evaluations by the edge worker",
+                     [(None, edges["evaluations"])], "counter")
+        self.metrics.render(lines)
+        sampler = self.sampler.stats()
+        publisher = self.publisher.stats() if self.publisher is not None else dict()
+        render_gauge(lines, prefix + "publisher_subscribers", "Connected subscribers of the state publisher",
+                     [(None, publisher.get("subscribers"))])
+        render_gauge(lines, prefix + "publisher_records_total", "Records published to subscribers",
+                     [(None, publisher.get("published"))], "counter")
+        render_gauge(lines, prefix + "publisher_dropped_total", "Subscribers disconnected for not keeping up",
+                     [(None, publisher.get("dropped"))], "counter")
+        notifications = self.notifications.stats()
+        render_gauge(lines, prefix + "notifications_total", "Alert deliveries to notification sinks by result",
+                     [(dict(result=result), notifications[result])
+                      for result in ("sent", "retries", "failed", "dropped", "duplicates")], "counter")
+        render_gauge(lines, prefix + "notifications_queued", "Alert deliveries waiting for a notification thread",
+                     [(None, notifications["queue"])])
+        layers = self.layer_indexer.stats()
+        render_gauge(lines, prefix + "layer_index_layers", "Layers found in the printed file",
+                     [(None, layers["layers"])])
+        render_gauge(lines, prefix + "layer_index_builds_total", "Layer indexes built by scanning a file",
+                     [(None, layers["builds"])], "counter")
+        render_gauge(lines, prefix + "layer_index_cache_hits_total", "Layer indexes loaded from the cache",
+                     [(None, layers["cache_hits"])], "counter")
+        render_gauge(lines, prefix + "layer_index_build_seconds", "Duration of the last layer index build",
+                     [(None, layers["build_time"])])
+        render_gauge(lines, prefix + "sampler_pins", "Pins polled because edge detection is not available",
+                     [(None, len(sampler["pins"]))])
+        render_gauge(lines, prefix + "sampler_passes_total", "Polling passes over all polled pins",
+                     [(None, sampler["passes"])], "counter")
+        render_gauge(lines, prefix + "sampler_changes_total", "Level changes found by polling",
+                     [(None, sampler["changes"])], "counter")
+        render_gauge(lines, prefix + "sampler_errors_total", "Polling passes which failed to read pins",
+                     [(None, sampler["errors"])], "counter")
+        render_gauge(lines, prefix + "sampler_overruns_total", "Polling passes started a whole period late",
+                     [(None, sampler["overruns"])], "counter")
+        render_gauge(lines, prefix + "sampler_cpu_ratio", "CPU time of the polling thread per second of polling",
+                     [(None, sampler["cpu_percent"] / 100 if sampler["cpu_percent"] is not None else None)])
+
+        states = self.sensor_states
+        monitors = self.motion_monitors
+        present = []
+        sensor_edges = []
+        pulses = []
+        for sensor in self.config.enabled_sensors:
+            labels = dict(sensor=sensor.name, pin=sensor.pin, type=sensor.type)
+            state = states.get(sensor.pin)
+            present.append((labels, None if state is None else state.present))
+            sensor_edges.append((labels, 0 if state is None else state.edges))
+            monitor = monitors.get(sensor.pin)
+            if monitor is not None:
+                pulses.append((labels, monitor.pulses))
+        tuning = [(dict(sensor=sensor.name, pin=sensor.pin), self.filters[sensor.pin])
+                  for sensor in self.config.switch_sensors if sensor.pin in self.filters]
+        render_gauge(lines, prefix + "bounce_time_ms", "Bounce time chosen by adaptive filtering",
+                     [(labels, noise_filter.bounce_time) for labels, noise_filter in tuning])
+        render_gauge(lines, prefix + "required_reads", "Required stable reads chosen by adaptive filtering",
+                     [(labels, noise_filter.debouncer.required) for labels, noise_filter in tuning])
+        render_gauge(lines, prefix + "noise", "Share of recent edge evaluations which looked like noise",
+                     [(labels, noise_filter.noise) for labels, noise_filter in tuning])
+        render_gauge(lines, prefix + "filament_present", "Last known debounced state, 1 filament present",
+                     present)
+        render_gauge(lines, prefix + "sensor_edges_total", "Edges evaluated per sensor", sensor_edges, "counter")
+        render_gauge(lines, prefix + "motion_pulses_total", "Pulses counted by motion sensors", pulses, "counter")
+        messages = []
+        for message_type, counters in sorted(self.messages.stats().items()):
+            for result, count in sorted(counters.items()):
+                messages.append((dict(type=message_type, result=result), count))
+        render_gauge(lines, prefix + "messages_total",
+                     "Plugin messages by type, result sent, delayed (sent later) or suppressed as repeats, "
+                     "rate_limited, unchanged or overflow",
+                     messages, "counter")
+        render_gauge(lines, prefix + "journal_written_total", "Sensor events written to the journal",
+                     [(None, self.history.written)], "counter")
+        render_gauge(lines, prefix + "journal_dropped_total", "Sensor events not written because the journal lagged",
+                     [(None, self.history.dropped)], "counter")
+        render_gauge(lines, prefix + "printing", "Print in progress", [(None, self.printing)])
+        render_gauge(lines, prefix + "ready", "GPIO initialized", [(None, self.gpio_initialized)])
+        render_gauge(lines, prefix + "ready_seconds", "Seconds from startup until GPIO was initialized",
+                     [(None, self.ready_time)])
+        job_gate = self.job_gate.state
+        render_gauge(lines, prefix + "job_gate_state", "Filament check of the current print job",
+                     [(dict(state=name), state == job_gate) for state, name in sorted(GATE_STATE_NAMES.items())])
+        filament_change = self.filament_change.state
+        render_gauge(lines, prefix + "filament_change_state", "Current filament change state",
+                     [(dict(state=name), state == filament_change) for state, name in sorted(STATE_NAMES.items())])
+        return lines
+
+    # current tuning of adaptive filtering per sensor
+    @octoprint.plugin.BlueprintPlugin.route("/filter", methods=["GET"])
+    def get_filter(self):
+        filters = self.filters
+        return flask.jsonify(enabled=self.config.filter_bounds is not None,
+                             sensors=[dict(filters[sensor.pin].as_dict(), name=sensor.name)
+                                      for sensor in self.config.switch_sensors if sensor.pin in filters])
+
+    # sensor events oldest first, page with after=<next of previous page>, filter by since/until (epoch seconds)
+    # and comma separated types
+    @octoprint.plugin.BlueprintPlugin.route("/history", methods=["GET"])
+    def get_history(self):
+        args = flask.request.args
+        try:
+            after = int(args.get("after", 0))
+            limit = max(1, min(int(args.get("limit", 100)), self.history_page_limit))
+            since = float(args["since"]) if args.get("since") else None
+            until = float(args["until"]) if args.get("until") else None
+        except ValueError:
+            return flask.make_response("Invalid history query", 400)
+        types = set(value for value in args.get("type", "").split(",") if value)
+        events, cursor = self.history.query(after, limit, since, until, types)
+        return flask.jsonify(events=events, next=cursor)
+
+    # test pin value, power pin or if its used by someone else, edge detection of configured sensors is never touched
     def on_api_command(self, command, data):
+        if not self.wait_ready():
+            return "", 503
+        if command == "scanPins":
+            with self.gpio_lock:
+                return self.scan_pins(data)
         try:
             selected_power = int(data.get("power"))
             selected_pin = int(data.get("pin"))
             mode = int(data.get("mode"))
             triggered_mode = int(data.get("triggered"))
 
-            if selected_pin is 0:
+            if selected_pin == 0:
                 return "", 556
 
-            self.init_gpio(mode, selected_pin, selected_power, triggered_mode, True)
-            triggered_int = self.is_filament_present(selected_pin, selected_power, triggered_mode)
-            self.init_gpio(self.setting_gpio_mode, self.setting_pin, self.setting_power, self.setting_triggered, True)
-            return flask.jsonify(triggered=triggered_int)
+            with self.gpio_lock:
+                probe = self.probe_pin(mode, selected_pin, selected_power, triggered_mode)
+            if probe["usage"] == "used":
+                return "", 555
+            if probe["usage"] == "mode":
+                return "", 557
+            if probe["noFilament"] is None:
+                return "", 556
+            self._logger.info("Filament not detected" if probe["noFilament"] else "Filament detected")
+            return flask.jsonify(triggered=1 if probe["noFilament"] else 0, cached=probe["cached"])
         except ValueError as e:
             self._logger.error(str(e))
             # ValueError occurs when reading from power, ground or out of range pins
             return "", 556
 
-    def is_filament_present(self, pin, power, triggered_mode):
-        if self.read_sensor_multiple(pin, power, triggered_mode):
-            self._logger.info("Filament detected")
-            return 0
+    # probes every candidate pin of the numbering mode in one request, quick reads keep it short
+    def scan_pins(self, data):
+        try:
+            mode = int(data.get("mode"))
+            power = int(data.get("power") or 0)
+            triggered = int(data.get("triggered") or 0)
+        except ValueError:
+            return "", 400
+        debouncer = Debouncer(required=3, samples=10, deadline=0.005)
+        pins = dict()
+        for pin in candidate_pins(mode):
+            try:
+                pins[str(pin)] = self.probe_pin(mode, pin, power, triggered, debouncer)
+            except (ValueError, RuntimeError) as e:
+                self._logger.debug("Scanning pin %s failed: %s" % (pin, e))
+                pins[str(pin)] = dict(pin=pin, usage="invalid", noFilament=None, sensor=None, cached=False)
+        return flask.jsonify(mode=mode, pins=pins)
+
+    # returns dict with usage (sensor, input, used by others, invalid or mode when GPIO is in use in the other
+    # numbering mode), noFilament read with given power and switch type, configured sensor name and whether the
+    # value comes from cached state, pins of configured sensors (edge detected or polled) are read as they are set up,
+    # other pins are set up for the read and released again unless a sensor is configured on them, inputs set up by
+    # other plugins are reported as used and left alone so their pull and edge detection stay
+    def probe_pin(self, mode, pin, power, triggered, debouncer=None):
+        probe = dict(pin=pin, usage="input", noFilament=None, sensor=None, cached=False)
+        current_mode = self.gpio.getmode()
+        if current_mode is not None and current_mode != mode:
+            probe["usage"] = "mode"
+            return probe
+        sensor = self.config.by_pin.get(pin)
+        if sensor is not None and (pin in self.detected_pins or pin in self.sampler.pins):
+            probe["usage"] = "sensor"
+            probe["sensor"] = sensor.name
+            if sensor.type == SENSOR_MOTION:
+                return probe
+            state = self.sensor_states.get(pin)
+            if (sensor.power, sensor.triggered) == (power, triggered) and state is not None \
+                    and state.present is not None:
+                probe["noFilament"] = not state.present
+                probe["cached"] = True
+            else:
+                probe["noFilament"] = not self.debounce_sensor(pin, power, triggered, debouncer).state
+            return probe
+
+        if current_mode is None:
+            self.gpio.setmode(mode)
+        if mode == self.gpio.BCM and pin > 27:
+            probe["usage"] = "invalid"
+            return probe
+        # raises ValueError for power and ground pins
+        if self.gpio.gpio_function(pin) != self.gpio.IN or sensor is None and self.gpio.is_setup(pin):
+            probe["usage"] = "used"
+            return probe
+        self.pull_resistor(pin, power)
+        try:
+            probe["noFilament"] = not self.debounce_sensor(pin, power, triggered, debouncer).state
+        finally:
+            # configured sensor which isn't watched yet keeps its setup
+            if sensor is None:
+                self.gpio.cleanup(pin)
+        return probe
+
+    # name of the sensor is added to messages only if there are more sensors
+    def runout_message(self, sensor, msg):
+        if sensor is not None and len(self.config.enabled_sensors) > 1:
+            return "%s (%s)" % (msg, sensor.name)
+        return msg
+
+    def send_message(self, data):
+        self.messages.send(data)
+
+    def deliver_message(self, data):
+        self._plugin_manager.send_plugin_message(self._identifier, data)
+
+    def show_printer_runout_popup(self, sensor=None):
+        msg = "Printer ran out of filament!"
+        location = self.runout_location
+        if location is not None:
+            msg = "Printer ran out of filament at layer %s of %s (Z %.2f mm)!" % (location["layer"],
+                                                                                location["layers"], location["z"])
+        self.send_message(dict(type="error", autoClose=False, msg=self.runout_message(sensor, msg),
+                               location=location))
+
+    # starts runout action unless filament change is already in progress, result is the reading which decided it
+    def trigger_runout(self, sensor, edge_time=None, result=None):
+        location = self.locate_print()
+        if not self.filament_change.begin_runout(sensor.name, edge_time, location):
+            return False
+        self.runout_location = location
+        self.metrics.runouts.inc()
+        self.record_event(JAM if sensor.type == SENSOR_MOTION else RUNOUT, sensor, result, self.runout_action(),
+                          location)
+        self.send_out_of_filament(sensor)
+        return True
+
+    # layer of the line the printer got last, None if not printing a local file or its index isn't built yet
+    def locate_print(self):
+        if not self.printing:
+            return None
+        try:
+            filepos = self._printer.get_current_data()["progress"]["filepos"]
+        except (KeyError, TypeError):
+            return None
+        return self.layer_indexer.locate(filepos)
+
+    def runout_action(self):
+        config = self.config
+        if config.cmd_action == 1:
+            return "pause"
+        return "inject" if config.runout_dispatch == DISPATCH_INJECT and self.printing else "gcode"
+
+    def record_event(self, type, sensor=None, result=None, action=None, location=None):
+        if result is None:
+            event = self.history.record(type, sensor, job=self.job_name, action=action, location=location)
         else:
-            self._logger.info("Filament not detected")
-            return 1
-
-    def show_printer_runout_popup(self):
-        self._plugin_manager.send_plugin_message(self._identifier,
-                                                 dict(type="error", autoClose=False, msg="Printer ran out of filament!"))
-
-    def send_out_of_filament(self):
-        self.show_printer_runout_popup()
-        if self.setting_cmd_action is 0:
-            self._logger.info("Sending out of filament GCODE: %s" % (self.setting_gcode))
-            self._printer.commands(self.setting_gcode)
-            self.changing_filament_initiated = True
-        elif self.setting_cmd_action is 1:
+            event = self.history.record(type, sensor, raw=result.first, present=result.state,
+                                        glitches=result.glitches, job=self.job_name, action=action, location=location)
+        publisher = self.publisher
+        # bounces didn't change anything subscribers know about
+        if publisher is not None and type != BOUNCE:
+            publisher.publish(event)
+        if type in self.notified_events:
+            self.notify_event(event, sensor)
+
+    # only queues the alert, delivery happens on the notification threads
+    def notify_event(self, event, sensor):
+        msg = self.notified_events[event["type"]]
+        location = event["location"]
+        if location is not None:
+            msg = "%s Layer %s of %s (Z %.2f mm)." % (msg, location["layer"], location["layers"], location["z"])
+        payload = dict(event, msg=self.runout_message(sensor, msg), printer=self.printer_name)
+        # each event is alerted once however often it is reported
+        self.notifications.notify("%s-%s" % (event["type"], event["seq"]), payload)
+
+    # last known state of every sensor, sent to a subscriber when it connects
+    def state_records(self):
+        states = self.sensor_states
+        now = time.time()
+        records = []
+        for sensor in self.config.enabled_sensors:
+            state = states.get(sensor.pin)
+            records.append(dict(type="state", time=now, sensor=sensor.name, pin=sensor.pin,
+                                present=state.present if state is not None else None, job=self.job_name,
+                                printing=self.printing))
+        return records
+
+    # starts, restarts or stops the publisher when its address changed
+    def configure_publisher(self):
+        config = self.config
+        address = config.publish_address
+        publisher = self.publisher
+        if publisher is not None and publisher.name == address and publisher.allow_remote == config.publish_remote:
+            return
+        if publisher is not None:
+            self.publisher = None
+            publisher.stop()
+        if not address:
+            return
+        try:
+            publisher = StatePublisher(address, self._logger, self.state_records, allow_remote=config.publish_remote)
+            publisher.start()
+        except (ValueError, socket.error, OSError) as e:
+            self._logger.error("Could not publish sensor states on %s: %s" % (address, e))
+            return
+        self.publisher = publisher
+
+    def configure_notifications(self):
+        alerts = self.config.alerts
+        sinks = []
+        if alerts.webhook_url:
+            sinks.append(WebhookSink(alerts.webhook_url, alerts.timeout))
+        if alerts.command:
+            sinks.append(CommandSink(alerts.command, alerts.timeout))
+        if alerts.mqtt_topic:
+            sinks.append(MqttSink(self._plugin_manager, alerts.mqtt_topic))
+        self.notifications.retries = alerts.retries
+        self.notifications.sinks = tuple(sinks)
+        self.printer_name = alerts.printer_name or socket.gethostname()
+
+    def send_out_of_filament(self, sensor):
+        config = self.config
+        self.show_printer_runout_popup(sensor)
+        if config.cmd_action == 0:
+            self._logger.info("Sending out of filament GCODE: %s" % sensor.gcode)
+            if config.runout_dispatch == DISPATCH_INJECT and self.printing:
+                if self.filament_change.queue_injection(split_commands(sensor.gcode)):
+                    # nothing is sent while the printer is idle, fall back to the printer queue then
+                    timer = threading.Timer(self.injection_timeout, self.injection_fallback)
+                    timer.daemon = True
+                    timer.start()
+                return
+            self.filament_change.transition(QUEUED)
+            self._printer.commands(sensor.gcode)
+        elif config.cmd_action == 1:
             self._logger.info("Pausing print using OctoPrint native pause")
-            self._printer.commands(self.setting_gcode)
+            self._printer.commands(sensor.gcode)
             self._printer.pause_print()
-
-    def sensor_callback(self, _):
-        self._logger.info("Sensor callback called")
-        filamentPresentInt = self.is_filament_present(self.setting_pin, self.setting_power, self.setting_triggered)
-        if filamentPresentInt is 1:
+            self.filament_change.transition(HOST_PAUSED)
+
+    def injection_fallback(self):
+        commands = self.filament_change.take_injection()
+        if commands:
+            self._logger.info("No line sent within %ss, queueing out of filament GCODE" % self.injection_timeout)
+            self.metrics.injection_fallbacks.inc()
+            self._printer.commands(commands)
+
+    # takes runout command waiting for injection, called on the comm thread by the queuing hook which puts it into the
+    # send queue, it is sent when the sending hook sees it
+    def inject_runout_command(self):
+        commands = self.filament_change.take_injection()
+        if not commands:
+            return None
+        self._logger.debug("injecting out of filament g-code ahead of next queued line")
+        self.metrics.injections.inc()
+        return commands
+
+    # latency from queueing of the runout command to sending it
+    def runout_command_sent(self):
+        trace = self.filament_change.trace
+        if trace is not None and trace.queued is not None and trace.sent is not None:
+            self.metrics.runout_dispatch.observe(trace.sent - trace.queued)
+
+    # called on the GPIO callback thread, only hands the edge over to the worker
+    def sensor_callback(self, channel):
+        monitor = self.motion_monitors.get(channel)
+        if monitor is not None:
+            # motion sensors only count pulses
+            monitor.pulses += 1
+            return
+        self.edge_worker.submit(channel)
+
+    # called on the edge worker thread with all edges of a burst on one pin
+    def handle_edges(self, pin, first_edge_time, edge_count):
+        sensor = self.config.by_pin.get(pin)
+        state = self.sensor_states.get(pin)
+        if sensor is None or state is None or sensor.type == SENSOR_MOTION:
+            self._logger.debug("Ignoring edge on pin %s without switch sensor" % pin)
+            return
+        self._logger.debug("Sensor callback called for %s on pin %s" % (sensor.name, pin))
+        if edge_count > 1:
+            self._logger.debug("Coalesced %s edges on pin %s" % (edge_count, pin))
+        state.edges += edge_count
+        previous = state.present
+        result = self.evaluate_sensor(sensor, first_edge_time)
+        if result.state == previous:
+            self.metrics.repeats.inc()
+            self.record_event(BOUNCE, sensor, result)
+        noise_filter = self.filters.get(pin)
+        if noise_filter is not None and noise_filter.observe(first_edge_time, edge_count, result,
+                                                             result.state != previous):
+            self._logger.info("Filtering of %s tuned to %s" % (sensor.name, noise_filter.as_dict()))
+            self.retune_edge_detection(sensor, noise_filter)
+        if not result.state:
             self._logger.info("Sensor was triggered")
-            if not self.changing_filament_initiated and self.printing:
-                self.send_out_of_filament()
+            runout = self.printing and self.trigger_runout(sensor, first_edge_time, result)
+            if not runout and result.state != previous:
+                self.record_event(REMOVED, sensor, result)
             # change navbar icon to filament runout
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="filamentStatus", noFilament=True,
-                                                                            msg="Printer ran out of filament!"))
-        elif filamentPresentInt is 0:
+            self.send_filament_status(sensor, "Printer ran out of filament!")
+        else:
             self._logger.info("Sensor was not triggered")
+            if result.state != previous:
+                self.record_event(INSERTED, sensor, result)
             # change navbar icon to filament present
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="filamentStatus", noFilament=False,
-                                                                            msg="Filament inserted!"))
+            self.send_filament_status(sensor, "Filament inserted!")
+
+    # reads sensor, updates its last known state and returns the debounced reading
+    def evaluate_sensor(self, sensor, timestamp=None):
+        noise_filter = self.filters.get(sensor.pin)
+        debouncer = noise_filter.debouncer if noise_filter is not None else sensor.debouncer
+        result = self.debounce_sensor(sensor.pin, sensor.power, sensor.triggered, debouncer)
+        state = self.sensor_states.get(sensor.pin)
+        if state is not None:
+            state.update(result.state, timestamp or monotonic(), result.glitches)
+        return result
+
+    # first enabled switch sensor without filament by its last known state or None, never reads GPIO so it can be
+    # called from the comm and event threads, switch sensor states follow both edges
+    def find_missing_filament(self):
+        if not self.gpio_initialized:
+            self._logger.info("Filament sensors not ready yet, skipping filament check")
+            return None
+        states = self.sensor_states
+        for sensor in self.config.switch_sensors:
+            state = states.get(sensor.pin)
+            if state is not None and state.present is False:
+                return sensor
+        return None
+
+    def sensors_status(self):
+        states = self.sensor_states
+        return [sensor_status(sensor, states.get(sensor.pin)) for sensor in self.config.enabled_sensors]
+
+    # rebuilds cached status from sensor states, returns True if it changed
+    def publish_status(self):
+        return self.status_cache.publish(self.sensors_status(), self.printing)
+
+    # sent only when status changed, clients which connect later get it from the status route
+    def send_filament_status(self, sensor, msg):
+        if not self.publish_status():
+            self.messages.suppress_unchanged("filamentStatus")
+            return
+        status = self.status_cache.status
+        self.send_message(dict(type="filamentStatus", noFilament=status["noFilament"],
+                               sensor=sensor.name if sensor is not None else None,
+                               sensors=status["sensors"], msg=msg))
 
-    def init_gpio(self, gpio_mode, pin, power, trigger_mode, test):
+    def init_gpio(self, gpio_mode, sensors):
         self._logger.info("Initializing GPIO.")
-        preset_gpio_mode = GPIO.getmode()
+        preset_gpio_mode = self.gpio.getmode()
         if preset_gpio_mode is not None:
             self.gpio_mode_disabled = True
             gpio_mode = preset_gpio_mode
@@ -166,277 +722,531 @@ class Filament_sensor_simplifiedPlugin(octoprint.plugin.StartupPlugin,
             self._logger.info("Preset mode is %s" % preset_gpio_mode)
 
         # Fix old -1 settings to 0
-        if pin is -1:
+        if sensors and sensors[0].pin == -1:
             self._logger.debug("Fixing old settings from -1 to 0")
             self._settings.set(["pin"], 0)
 
-        if self.plugin_enabled(pin):
-            self._logger.info("Enabling filament sensor.")
-            self._logger.info("Mode is %s" % gpio_mode)
-            # BOARD
-            if gpio_mode is 10:
-                # if mode set by 3rd party don't set it again
-                if not self.gpio_mode_disabled:
-                    self._logger.info("Setting Board mode")
-                    GPIO.cleanup()
-                    GPIO.setmode(GPIO.BOARD)
+        enabled = [sensor for sensor in sensors if sensor.enabled]
+        # forget pins of sensors which were removed
+        watched = self.detected_pins | set(self.sampler.pins)
+        self.remove_edge_detection(watched - set(sensor.pin for sensor in enabled))
+        if not enabled:
+            self._logger.info("Sensor disabled")
+            return
+
+        self._logger.info("Enabling filament sensor.")
+        self._logger.info("Mode is %s" % gpio_mode)
+        # BOARD
+        if gpio_mode == 10:
+            # if mode set by 3rd party don't set it again
+            if not self.gpio_mode_disabled:
+                self._logger.info("Setting Board mode")
+                self.gpio.cleanup()
+                self.detected_pins.clear()
+                self.gpio.setmode(self.gpio.BOARD)
+        # BCM
+        elif gpio_mode == 11:
+            # if mode set by 3rd party don't set it again
+            if not self.gpio_mode_disabled:
+                self._logger.debug("Setting BCM mode")
+                self.gpio.cleanup()
+                self.detected_pins.clear()
+                self.gpio.setmode(self.gpio.BCM)
+
+        result = None
+        for sensor in enabled:
+            pin = sensor.pin
+            if gpio_mode == 10:
                 # first check pins not in use already
-                usage = GPIO.gpio_function(pin)
+                usage = self.gpio.gpio_function(pin)
                 self._logger.debug("usage on pin %s is %s" % (pin, usage))
                 # 1 = input
-                if usage is not 1:
+                if usage != 1:
                     # 555 is not http specific so I chose it
-                    return "", 555
-            # BCM
-            elif gpio_mode is 11:
+                    result = "", 555
+                    continue
+            elif gpio_mode == 11:
                 # BCM range 1-27
                 if pin > 27:
-                    return "", 556
-                # if mode set by 3rd party don't set it again
-                if not self.gpio_mode_disabled:
-                    self._logger.debug("Setting BCM mode")
-                    GPIO.cleanup()
-                    GPIO.setmode(GPIO.BCM)
-            if not test:
-                try:
-                    # 0 = sensor is grounded, react to rising edge pulled up by pull up resistor
-                    if power is 0:
-                        self.pull_resistor(pin, power)
-                        # triggered when open
-                        if trigger_mode is 0:
-                            self._logger.debug("Reacting to rising edge")
-                            GPIO.add_event_detect(
-                                pin, GPIO.RISING,
-                                callback=self.sensor_callback,
-                                bouncetime=self.bounce_time)
-                        # triggered when closed
-                        else:
-                            self._logger.debug("Reacting to falling edge")
-                            GPIO.add_event_detect(
-                                pin, GPIO.FALLING,
-                                callback=self.sensor_callback,
-                                bouncetime=self.bounce_time)
-
-                    # 1 = sensor is powered, react to falling edge pulled down by pull down resistor
-                    else:
-                        self.pull_resistor(pin, power)
-                        # triggered when open
-                        if trigger_mode is 0:
-                            self._logger.debug("Reacting to falling edge")
-                            GPIO.add_event_detect(
-                                pin, GPIO.FALLING,
-                                callback=self.sensor_callback,
-                                bouncetime=self.bounce_time)
-                        # triggered when closed
-                        else:
-                            self._logger.debug("Reacting to rising edge")
-                            GPIO.add_event_detect(
-                                pin, GPIO.RISING,
-                                callback=self.sensor_callback,
-                                bouncetime=self.bounce_time)
-                except RuntimeError as e:
-                    self._logger.warn(str(e))
-        else:
-            self._logger.info("Sensor disabled")
+                    result = "", 556
+                    continue
+            self.init_edge_detection(sensor)
+        return result
+
+    def init_edge_detection(self, sensor):
+        pin = sensor.pin
+        try:
+            self.pull_resistor(pin, sensor.power)
+            noise_filter = self.filters.get(pin)
+            bouncetime = noise_filter.bounce_time if noise_filter is not None else self.bounce_time
+            # motion sensor pulses are counted on both edges without bounce time
+            if sensor.type == SENSOR_MOTION:
+                self._logger.debug("Counting pulses on pin %s" % pin)
+                edge = self.gpio.BOTH
+                bouncetime = None
+            # switches react to both edges so that insertion keeps the cached state current too, the debouncer
+            # decides which way the sensor went
+            else:
+                self._logger.debug("Reacting to both edges on pin %s" % pin)
+                edge = self.gpio.BOTH
+            if pin in self.detected_pins:
+                self.gpio.remove_event_detect(pin)
+            self.gpio.add_event_detect(pin, edge, callback=self.sensor_callback, bouncetime=bouncetime)
+            self.detected_pins.add(pin)
+            self.sampler.unwatch(pin)
+        except RuntimeError as e:
+            # e.g. kernel without edge detection support, the pin is polled instead
+            self._logger.warn("Edge detection on pin %s not available (%s), polling it %s times per second"
+                              % (pin, e, self.sampler.rate))
+            self.sampler.watch(pin)
+
+    # registers edge detection again with the bounce time chosen by adaptive filtering, called on the edge worker
+    def retune_edge_detection(self, sensor, noise_filter):
+        with self.gpio_lock:
+            # settings were saved meanwhile, init_gpio already set up the pin for the new config
+            if self.config.by_pin.get(sensor.pin) is not sensor or self.filters.get(sensor.pin) is not noise_filter:
+                self._logger.debug("Sensor %s changed, not retuning edge detection" % sensor.name)
+                return
+            self.init_edge_detection(sensor)
+
+    def remove_edge_detection(self, pins):
+        for pin in list(pins):
+            try:
+                self.gpio.remove_event_detect(pin)
+            except (RuntimeError, ValueError) as e:
+                self._logger.debug(str(e))
+            self.detected_pins.discard(pin)
+            self.sampler.unwatch(pin)
 
     # pulls resistor up or down based on the parameters
     def pull_resistor(self, pin, power):
-        if power is 0:
+        if power == 0:
             self._logger.debug("Pulling up resistor")
-            GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        elif power is 1:
+            self.gpio.setup(pin, self.gpio.IN, pull_up_down=self.gpio.PUD_UP)
+        elif power == 1:
             self._logger.debug("Pulling down resistor")
-            GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+            self.gpio.setup(pin, self.gpio.IN, pull_up_down=self.gpio.PUD_DOWN)
         self._logger.debug("Done")
 
     def on_after_startup(self):
         self._logger.info("Filament Sensor Simplified started")
-        self.init_gpio(self.setting_gpio_mode, self.setting_pin, self.setting_power, self.setting_triggered, False)
-        self.gpio_initialized = True
+        self.edge_worker.start()
+        self.history.start()
+        self.configure_publisher()
+        self.configure_notifications()
+        self.notifications.start()
+        thread = threading.Thread(target=self.initialize_gpio, args=(monotonic(),),
+                                  name="filamentsensorsimplified gpio init")
+        thread.daemon = True
+        thread.start()
+
+    # runs on its own thread, sets ready when done even if GPIO couldn't be set up
+    def initialize_gpio(self, started):
+        try:
+            with self.gpio_lock:
+                if self.gpio is None:
+                    self.gpio = create_backend(self.config.gpio_backend)
+                    self.gpio.setwarnings(True)
+                config = self.config
+                self.init_gpio(config.gpio_mode, config.sensors)
+                # init_gpio may fix stored settings (preset GPIO mode, old pin values)
+                self.load_config()
+                self.gpio_initialized = True
+            self.ready_time = monotonic() - started
+            self._logger.info("GPIO ready in %.1f ms" % (self.ready_time * 1000))
+            # the only read outside of edges and print checks, fills cached status
+            self.init_icon()
+        except Exception:
+            self._logger.exception("Could not initialize GPIO")
+        finally:
+            self.ready.set()
+
+    # waits for the initializer in requests which need GPIO, returns whether GPIO is usable
+    def wait_ready(self):
+        self.ready.wait(self.ready_timeout)
+        return self.gpio_initialized
+
+    def on_shutdown(self):
+        self.edge_worker.stop()
+        self.sampler.stop()
+        if self.publisher is not None:
+            self.publisher.stop()
+        self.notifications.stop()
+        self.messages.cancel()
+        self.history.stop()
+
+    # checks if pin is not power/ground pin, out of range or used by others
+    def validate_pin(self, gpio_mode, pin):
+        try:
+            # BOARD
+            if gpio_mode == 10:
+                # before saving check if pin not used by others
+                usage = self.gpio.gpio_function(pin)
+                self._logger.debug("usage on pin %s is %s" % (pin, usage))
+                if usage != 1:
+                    self._logger.info("You are trying to save pin %s which is already used by others" % pin)
+                    self.send_message(dict(type="error", autoClose=True,
+                                           msg="Filament sensor settings not saved, you are trying to use a pin which is already used by others"))
+                    return False
+            # BCM
+            elif gpio_mode == 11:
+                if pin > 27:
+                    self._logger.info("You are trying to save pin %s which is out of range" % pin)
+                    self.send_message(dict(type="error", autoClose=True,
+                                           msg="Filament sensor settings not saved, you are trying to use a pin which is out of range"))
+                    return False
+        except ValueError:
+            self._logger.info("You are trying to save pin %s which is ground/power pin or out of range" % pin)
+            self.send_message(dict(type="error", autoClose=True,
+                                   msg="Filament sensor settings not saved, you are trying to use a pin which is ground/power pin or out of range"))
+            return False
+        return True
 
     def on_settings_save(self, data):
         # Retrieve any settings not changed in order to validate that the combination of new and old settings end up in a bad combination
         self._logger.info("Saving settings for Filament Sensor Simplified")
-        pin_to_save = self._settings.get_int(["pin"])
+        if not self.wait_ready():
+            self._logger.warning("GPIO not initialized, saving settings without validating pins")
+            octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+            self.load_config()
+            self.configure_publisher()
+            self.configure_notifications()
+            return
         gpio_mode_to_save = self._settings.get_int(["gpio_mode"])
-        power_to_save = self._settings.get_int(["power"])
-        trigger_mode_to_save = self._settings.get_int(["triggered"])
+        pin_to_save = self._settings.get_int(["pin"])
+        sensors_to_save = self._settings.get(["sensors"]) or []
+
+        if "gpio_mode" in data:
+            gpio_mode_to_save = int(data.get("gpio_mode"))
 
         if "pin" in data:
             pin_to_save = int(data.get("pin"))
 
-        if "gpio_mode" in data:
-            gpio_mode_to_save = int(data.get("gpio_mode"))
+        if "sensors" in data:
+            sensors_to_save = data.get("sensors") or []
+
+        pins_to_save = [pin_to_save or 0] + [int(sensor.get("pin") or 0) for sensor in sensors_to_save]
+        # allow the disabled value (0)
+        pins_to_save = [pin for pin in pins_to_save if pin != 0]
+        if len(set(pins_to_save)) != len(pins_to_save):
+            self._logger.info("You are trying to save the same pin for more sensors")
+            self.send_message(dict(type="error", autoClose=True,
+                                   msg="Filament sensor settings not saved, you are trying to use the same pin for more sensors"))
+            return
+        for pin in pins_to_save:
+            if not self.validate_pin(gpio_mode_to_save, pin):
+                return
 
-        if "power" in data:
-            power_to_save = int(data.get("power"))
-
-        if "trigger" in data:
-            trigger_mode_to_save = int(data.get("triggered"))
-
-        if pin_to_save is not None:
-            # check if pin is not power/ground pin or out of range but allow the disabled value (0)
-            if pin_to_save is not 0:
-                try:
-                    # BOARD
-                    if gpio_mode_to_save is 10:
-                        # before saving check if pin not used by others
-                        usage = GPIO.gpio_function(pin_to_save)
-                        self._logger.debug("usage on pin %s is %s" % (pin_to_save, usage))
-                        if usage is not 1:
-                            self._logger.info(
-                                "You are trying to save pin %s which is already used by others" % (pin_to_save))
-                            self._plugin_manager.send_plugin_message(self._identifier,
-                                                                     dict(type="error", autoClose=True,
-                                                                          msg="Filament sensor settings not saved, you are trying to use a pin which is already used by others"))
-                            return
-                    # BCM
-                    elif gpio_mode_to_save is 11:
-                        if pin_to_save > 27:
-                            self._logger.info(
-                                "You are trying to save pin %s which is out of range" % (pin_to_save))
-                            self._plugin_manager.send_plugin_message(self._identifier,
-                                                                     dict(type="error", autoClose=True,
-                                                                          msg="Filament sensor settings not saved, you are trying to use a pin which is out of range"))
-                            return
-
-                except ValueError:
-                    self._logger.info(
-                        "You are trying to save pin %s which is ground/power pin or out of range" % (pin_to_save))
-                    self._plugin_manager.send_plugin_message(self._identifier, dict(type="error", autoClose=True,
-                                                                                    msg="Filament sensor settings not saved, you are trying to use a pin which is ground/power pin or out of range"))
-                    return
-                self.init_gpio(gpio_mode_to_save, pin_to_save, power_to_save, trigger_mode_to_save, False)
-                self.init_icon(pin_to_save, power_to_save, trigger_mode_to_save)
         octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+        with self.gpio_lock:
+            self.load_config()
+            config = self.config
+            self.init_gpio(config.gpio_mode, config.sensors)
+        self.configure_publisher()
+        self.configure_notifications()
+        self.init_icon()
+
+    # called on the comm thread for every line entering the send queue, OctoPrint lets only this phase turn one line
+    # into more
+    def queuing_gcode(self, comm_instance, phase, cmd, cmd_type, gcode, subcode=None, tags=None, *args, **kwargs):
+        if self.job_gate.state != OPEN and is_job_line(tags):
+            return self.gate_job_line()
+        # runout command goes out right before this line
+        if self.filament_change.injection is not None:
+            injected = self.inject_runout_command()
+            if injected:
+                # own type and tags, bare strings would get type and tags of the line they come with and could be
+                # dropped as a duplicate of a typed command
+                return [(command, None, set(self.injection_tags)) for command in injected] + [(cmd, cmd_type)]
+
+    # holds a print job back before its first line goes to the printer when a sensor has no filament, so heating and
+    # start g-code are never sent
+    def gate_job_line(self):
+        job_gate = self.job_gate
+        state, decided = job_gate.decide(self.find_missing_filament)
+        if state != HELD:
+            return
+        if job_gate.hold():
+            # OctoPrint keeps reading job lines until one is queued, on hold it stops after this dropped line instead
+            # of dropping the rest of the file, the comm thread already owns the job lock so this doesn't wait
+            self._printer.set_job_on_hold(True)
+        if decided:
+            # cancelling from the comm thread could wait for the comm thread itself
+            thread = threading.Thread(target=self.hold_job, args=(job_gate.sensor,),
+                                      name="filamentsensorsimplified hold job")
+            thread.daemon = True
+            thread.start()
+        # line of held job is dropped
+        return None,
+
+    def hold_job(self, sensor):
+        self._logger.info("Print held back: no filament detected by %s!" % sensor.name)
+        self.metrics.jobs_held.inc()
+        self._printer.cancel_print()
+        self.release_job()
+        self.record_event(PRINT_CANCELLED, sensor, action="hold")
+        self.send_message(dict(type="error", autoClose=True,
+                               msg=self.runout_message(sensor, "No filament detected! Print not started.")))
+
+    # ends the hold of a held job once it is cancelled, the next job must not start on hold
+    def release_job(self):
+        if self.job_gate.release():
+            self._printer.set_job_on_hold(False)
 
     def sending_gcode(self, comm_instance, phase, cmd, cmd_type, gcode, subcode=None, tags=None, *args, **kwargs):
-        if self.changing_filament_initiated:
-            if self.changing_filament_command_sent and self.changing_filament_started:
-                # M113 - host keepalive message, ignore this message
-                if not re.search("^M113", cmd):
-                    self._logger.debug("filament change sequence ended")
-                    self.changing_filament_initiated = False
-                    self.changing_filament_command_sent = False
-                    self.changing_filament_started = False
-                    if not self.read_sensor_multiple(self.setting_pin, self.setting_power, self.setting_triggered):
-                        self._logger.debug("reading sensor after change")
-                        self.send_out_of_filament()
-            if cmd == self.setting_gcode:
+        # nothing to track before sensors are set up
+        if not self.gpio_initialized:
+            return
+        self.sending_countdown -= 1
+        if not self.sending_countdown:
+            return self.timed_sending_gcode(comm_instance, phase, cmd, cmd_type, gcode, subcode, tags, *args, **kwargs)
+
+        if self.motion_monitors:
+            extruded = self.extrusion_tracker.feed(gcode, cmd)
+            if extruded:
+                self.check_motion(extruded)
+
+        # fast path, no filament change in progress and line is not a filament change
+        filament_change = self.filament_change
+        if not filament_change.state and not cmd.startswith(FILAMENT_CHANGE_PREFIX):
+            return
+
+        kind = self.config.gcode_classifier.classify(cmd)
+        if filament_change.state:
+            # M113 - host keepalive message, ignore this message
+            if not kind & KEEPALIVE and filament_change.transition(LINE_SENT):
+                self.filament_change_ended()
+            if kind & RUNOUT_COMMAND and filament_change.transition(SENT):
                 self._logger.debug("about to send out of filament g-code")
-                self.changing_filament_command_sent = True
+                self.runout_command_sent()
 
         # deliberate change
-        if re.search("^M600", cmd):
+        if kind & FILAMENT_CHANGE and filament_change.transition(SENT):
             self._logger.info("deliberate M600 was initiated")
-            self.changing_filament_initiated = True
-            self.changing_filament_command_sent = True
+
+    def timed_sending_gcode(self, *args, **kwargs):
+        self.sending_countdown = self.hook_timing_interval
+        start = monotonic()
+        try:
+            return self.sending_gcode(*args, **kwargs)
+        finally:
+            self.metrics.sending_gcode.observe(monotonic() - start)
+
+    # called on the comm thread for lines extruding filament
+    def check_motion(self, extruded):
+        if not self.printing or self.filament_change.state:
+            return
+        for pin, monitor in self.motion_monitors.items():
+            moving = monitor.extruded(extruded)
+            if moving is None:
+                continue
+            sensor = self.config.by_pin.get(pin)
+            state = self.sensor_states.get(pin)
+            if sensor is None or state is None or not state.update(moving, monotonic()):
+                continue
+            if moving:
+                self._logger.info("Filament is moving on %s" % sensor.name)
+                self.send_filament_status(sensor, "Filament is moving")
+            else:
+                self._logger.info("Filament jam detected by %s: %.3f pulses per mm" % (sensor.name, monitor.rate))
+                self.send_filament_status(sensor, "Filament is not moving!")
+                self.trigger_runout(sensor)
+
+    # filament movement is evaluated from scratch after print start or filament change
+    # a new job also starts from default positioning and extruder mode, the job sets its own before extruding, after a
+    # filament change or resume the modes of the running job stay
+    def reset_motion(self, new_job=False):
+        if new_job:
+            self.extrusion_tracker.reset()
+        for monitor in self.motion_monitors.values():
+            monitor.reset()
 
     def gcode_response_received(self, comm, line, *args, **kwargs):
-        if self.changing_filament_command_sent:
-            if re.search("busy: paused for user", line):
+        if not self.gpio_initialized:
+            return line
+        self.received_countdown -= 1
+        if not self.received_countdown:
+            return self.timed_gcode_response_received(comm, line, *args, **kwargs)
+
+        filament_change = self.filament_change
+        if filament_change.command_sent:
+            if "busy: paused for user" in line:
                 self._logger.debug("received busy paused for user")
-                if not self.paused_for_user:
-                    self._plugin_manager.send_plugin_message(self._identifier, dict(type="info", autoClose=False,
-                                                                                    msg="Filament change: printer is waiting for user input."))
-                    self.paused_for_user = True
-                    self.changing_filament_started = True
-            elif re.search("echo:busy: processing", line):
+                if filament_change.transition(PAUSED):
+                    self.send_message(dict(type="info", autoClose=False,
+                                           msg="Filament change: printer is waiting for user input."))
+            elif "echo:busy: processing" in line:
                 self._logger.debug("received busy processing")
-                if self.paused_for_user:
-                    self.paused_for_user = False
+                filament_change.transition(PROCESSING)
+        if line.startswith(SD_PREFIXES):
+            self.handle_sd_status(line)
         return line
 
-    def init_icon(self, pin, power, triggered):
+    # printer continues after filament change, checks the new filament
+    def filament_change_ended(self):
+        self._logger.debug("filament change sequence ended")
+        self.record_event(RECOVERED)
+        self.reset_motion()
+        missing = self.find_missing_filament()
+        if missing is not None:
+            self._logger.debug("reading sensor after change")
+            self.trigger_runout(missing)
+
+    # SD card print status, the job lines never go through the sending hook so print state and the end of a filament
+    # change are followed from status reports, called on the comm thread
+    def handle_sd_status(self, line):
+        event = self.sd_tracker.feed(line)
+        if event is None:
+            return
+        self._logger.debug("SD card print %s: %s" % (event, self.sd_tracker.as_dict()))
+        if event in (SD_STARTED, SD_ADVANCED):
+            if not self.printing:
+                # print started on the printer itself
+                self._logger.info("SD card print detected")
+                self.sd_printing = True
+                self.printing = True
+                self.publish_status()
+            if event == SD_STARTED:
+                self.enable_sd_autoreport()
+            # position moves again after the filament change
+            if self.filament_change.state >= PAUSED_FOR_USER and self.filament_change.transition(LINE_SENT):
+                self.filament_change_ended()
+        elif event == SD_DONE or (event == SD_STOPPED and not self.filament_change.state):
+            if self.sd_printing:
+                self._logger.info("SD card print ended")
+                self.sd_printing = False
+                self.printing = False
+                self.publish_status()
+
+    # asks firmware able to report SD status by itself to do so, OctoPrint then doesn't have to poll with M27
+    def enable_sd_autoreport(self):
+        tracker = self.sd_tracker
+        interval = self.config.sd_status_interval
+        if not tracker.autoreport or tracker.autoreport_enabled or not interval:
+            return
+        tracker.autoreport_enabled = True
+        self._logger.debug("Enabling SD status autoreport every %s s" % interval)
+        self._printer.commands("M27 S%d" % interval)
+
+    def timed_gcode_response_received(self, *args, **kwargs):
+        self.received_countdown = self.hook_timing_interval
+        start = monotonic()
+        try:
+            return self.gcode_response_received(*args, **kwargs)
+        finally:
+            self.metrics.gcode_received.observe(monotonic() - start)
+
+    def init_icon(self):
         if not self.gpio_initialized:
             return
         self._logger.info("Setting icon status")
-        iconPresent = self.is_filament_present(pin, power, triggered)
-        self._plugin_manager.send_plugin_message(self._identifier,
-                                                 dict(type="filamentStatus", noFilament=iconPresent,
-                                                      msg="Initial filament read"))
+        for sensor in self.config.switch_sensors:
+            self.evaluate_sensor(sensor)
+        self.send_filament_status(None, "Initial filament read")
 
     def read_sensor_multiple(self, pin, power, trigger_mode):
-        self._logger.info("Reading sensor values")
-        oldTrigger = None
-        x = 0
-
-        # take a reading of 10 consecutive reads to prevent false positives
-        while True:
-            newTrigger = self.read_sensor(pin, power, trigger_mode)
-            x += 1
-
-            if oldTrigger is None:
-                oldTrigger = newTrigger
-            elif oldTrigger != newTrigger:
-                x = 0
-                self._logger.info("Repeating sensor read due to false positives")
-
-            if x >= 10:
-                self._logger.info("Reading result: %s" % newTrigger)
-                return newTrigger
-
-    # plugin disabled if pin set to 0
-    def plugin_enabled(self, pin):
-        return pin != 0
-
-    # read sensor input value
+        return self.debounce_sensor(pin, power, trigger_mode).state
+
+    # take bounded number of reads to prevent false positives
+    def debounce_sensor(self, pin, power, trigger_mode, debouncer=None):
+        debouncer = debouncer or self.config.primary.debouncer
+        result = debouncer.decide(lambda: self.read_sensor(pin, power, trigger_mode))
+        metrics = self.metrics
+        metrics.debounce_samples.inc(result.samples)
+        if result.glitches:
+            metrics.debounce_glitches.inc(result.glitches)
+        if result.timed_out:
+            metrics.debounce_timeouts.inc()
+        if result.glitches:
+            self._logger.debug("Glitches while reading pin %s: %s" % (pin, result))
+        if result.timed_out:
+            self._logger.info("Sensor reading on pin %s not stable, forced result: %s" % (pin, result))
+        return result
+
+    # read sensor input value, pin has to be set up by pull_resistor first
     def read_sensor(self, pin, power, trigger_mode):
-        self._logger.debug("reading pin %s " % pin)
-        self.pull_resistor(pin, power)
-        pin_value = GPIO.input(pin)
-        return (pin_value + power + trigger_mode) % 2 is 0
+        pin_value = self.gpio.input(pin)
+        return (pin_value + power + trigger_mode) % 2 == 0
 
     def on_event(self, event, payload):
+        config = self.config
         # if user has logged in show appropriate popup
         if event is Events.CLIENT_OPENED:
-            # if plugin enabled init icon on client open
-            if self.plugin_enabled(self.setting_pin):
-                self.init_icon(self.setting_pin, self.setting_power, self.setting_triggered)
-            if self.changing_filament_initiated and not self.changing_filament_command_sent:
-                self.show_printer_runout_popup()
-            elif self.changing_filament_command_sent and not self.paused_for_user:
+            # clients get the navbar icon from the status route, answered from cached status
+            filament_change = self.filament_change
+            if filament_change.initiated and not filament_change.paused_for_user:
                 self.show_printer_runout_popup()
             # printer is waiting for user to put in new filament
-            elif self.changing_filament_command_sent and self.paused_for_user:
-                self._plugin_manager.send_plugin_message(self._identifier, dict(type="info", autoClose=False,
-                                                                                msg="Printer ran out of filament! It's waiting for user input"))
+            elif filament_change.paused_for_user:
+                self.send_message(dict(type="info", autoClose=False,
+                                       msg="Printer ran out of filament! It's waiting for user input"))
             # if the plugin hasn't been initialized
-            if not self.plugin_enabled(self.setting_pin):
-                self._plugin_manager.send_plugin_message(self._identifier, dict(type="info", autoClose=True,
-                                                                                msg="Don't forget to configure this plugin."))
+            if not config.enabled:
+                self.send_message(dict(type="info", autoClose=True,
+                                       msg="Don't forget to configure this plugin."))
 
         elif event in (Events.PRINT_STARTED, Events.PRINT_RESUMED):
-            self.changing_filament_initiated = False
-            self.changing_filament_command_sent = False
-            self.paused_for_user = False
+            if event is Events.PRINT_STARTED:
+                self.job_name = (payload or {}).get("name")
+                self.runout_location = None
+                self.index_layers(payload or {})
+                if (payload or {}).get("origin") == FileDestinations.SDCARD:
+                    self.sd_tracker.reset()
+                    self.enable_sd_autoreport()
+            self.filament_change.reset()
             self.printing = True
+            self.publish_status()
+            self.reset_motion(event is Events.PRINT_STARTED)
 
-            # print started with no filament present
-            if event is Events.PRINT_STARTED and self.plugin_enabled(self.setting_pin):
+            # print started with no filament present, usually the gate has already held the job back at its first
+            # line, otherwise it is decided here and the gate holds the job at its first line
+            if event is Events.PRINT_STARTED and config.enabled:
                 self._logger.info("Starting print.")
-                if not self.read_sensor_multiple(self.setting_pin, self.setting_power, self.setting_triggered):
-                    self._logger.info("Printing aborted: no filament detected!")
-                    self._printer.cancel_print()
-                    self._plugin_manager.send_plugin_message(self._identifier, dict(type="error", autoClose=True,
-                                                                                    msg="No filament detected! Print cancelled."))
+                state, decided = self.job_gate.decide(self.find_missing_filament)
+                if decided and state == HELD:
+                    self.hold_job(self.job_gate.sensor)
             # print resumed with no filament present
-            elif event is Events.PRINT_RESUMED and self.plugin_enabled(self.setting_pin):
+            elif event is Events.PRINT_RESUMED and config.enabled:
                 self._logger.info("Resuming print.")
-                if not self.read_sensor_multiple(self.setting_pin, self.setting_power, self.setting_triggered):
-                    self._logger.info("Resuming print aborted: no filament detected!")
-                    self.send_out_of_filament()
-                    self._plugin_manager.send_plugin_message(self._identifier, dict(type="error", autoClose=True,
-                                                                                    msg="Resuming print aborted: no filament detected!"))
+                missing = self.find_missing_filament()
+                if missing is not None:
+                    self._logger.info("Resuming print aborted: no filament detected by %s!" % missing.name)
+                    self.trigger_runout(missing)
+                    self.send_message(dict(type="error", autoClose=True,
+                                           msg="Resuming print aborted: no filament detected!"))
 
         elif event in (Events.PRINT_DONE,
                 Events.PRINT_FAILED,
                 Events.PRINT_CANCELLED,
                 Events.ERROR):
-            self.changing_filament_initiated = False
-            self.changing_filament_command_sent = False
-            self.paused_for_user = False
+            self.filament_change.reset()
             self.printing = False
+            self.job_name = None
+            self.sd_printing = False
+            self.release_job()
+            self.job_gate.reset()
+            self.layer_indexer.cancel()
+            self.publish_status()
+
+    # starts building layer index of the printed file, files printed from SD card can't be indexed
+    def index_layers(self, payload):
+        path = payload.get("path")
+        if payload.get("origin") != FileDestinations.LOCAL or not path:
+            self.layer_indexer.cancel()
+            return
+        try:
+            disk_path = self._file_manager.path_on_disk(FileDestinations.LOCAL, path)
+        except Exception:
+            self._logger.exception("Could not find %s on disk" % path)
+            self.layer_indexer.cancel()
+            return
+
+        # hash computed by OctoPrint on upload, read on the indexing thread
+        def file_hash():
+            metadata = self._file_manager.get_metadata(FileDestinations.LOCAL, path) or dict()
+            return metadata.get("hash")
+
+        self.layer_indexer.start(disk_path, file_hash)
 
     def get_update_information(self):
         # Define the configuration for your plugin to use with the Software Update
@@ -470,14 +1280,10 @@ __plugin_name__ = "Filament Sensor Simplified"
 __plugin_version__ = "0.3.3"
 
 
+# RPi.GPIO is imported by the GPIO initializer, here only its presence is checked so that plugin loading stays fast,
+# the version (at least 0.6 for edge detection) is checked when the backend is created
 def __plugin_check__():
-    try:
-        import RPi.GPIO as GPIO
-        if GPIO.VERSION < "0.6":  # Need at least 0.6 for edge detection
-            return False
-    except ImportError:
-        return False
-    return True
+    return module_available("RPi.GPIO")
 
 
 def __plugin_load__():
@@ -488,5 +1294,6 @@ def __plugin_load__():
     __plugin_hooks__ = {
         "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
         "octoprint.comm.protocol.gcode.received": __plugin_implementation__.gcode_response_received,
+        "octoprint.comm.protocol.gcode.queuing": __plugin_implementation__.queuing_gcode,
         "octoprint.comm.protocol.gcode.sending": __plugin_implementation__.sending_gcode
     }
@@ -0,0 +1,94 @@
+# coding=utf-8
+from __future__ import absolute_import, division
+
+from collections import deque
+
+from .debounce import Debouncer
+
+
+class AdaptiveFilter(object):
+    # tunes GPIO bounce time and required stable reads of one switch sensor from the noise seen on its edges, noisy
+    # sensors get a longer bounce time and more required reads, clean sensors are stepped back down to react faster,
+    # only ever touched by the edge worker thread
+    __slots__ = ("pin", "bounds", "debouncer", "bounce_time", "noise", "evaluations", "noisy", "since_change",
+                 "changes", "last_edge", "widths")
+
+    # weight of the last evaluation in the noise average
+    smoothing = 0.2
+    # noise average above which filtering is stepped up, below which it is stepped down
+    noisy_level = 0.3
+    clean_level = 0.05
+    # evaluations between two adjustments
+    settle = 8
+    # number of recent pulse widths kept for the report
+    width_history = 32
+
+    def __init__(self, pin, debouncer, bounce_time, bounds):
+        self.pin = pin
+        self.bounds = bounds
+        self.debouncer = self._debouncer(debouncer, debouncer.required)
+        self.bounce_time = self._clamp(bounce_time, bounds.bounce_time_min, bounds.bounce_time_max)
+        self.noise = 0.0
+        self.evaluations = 0
+        self.noisy = 0
+        self.since_change = 0
+        self.changes = 0
+        self.last_edge = None
+        # seconds between consecutive edge bursts which didn't change the state
+        self.widths = deque(maxlen=self.width_history)
+
+    @staticmethod
+    def _clamp(value, low, high):
+        return max(low, min(high, int(value)))
+
+    def _debouncer(self, debouncer, required):
+        required = self._clamp(required, self.bounds.required_min, self.bounds.required_max)
+        return Debouncer(mode=debouncer.mode, samples=max(debouncer.samples, required), required=required,
+                         interval=debouncer.interval, deadline=debouncer.deadline)
+
+    # feeds one evaluation of an edge burst, returns True if bounce time changed and edge detection has to be
+    # registered again
+    def observe(self, edge_time, edge_count, result, changed):
+        noisy = edge_count > 1 or result.glitches > 0 or not changed
+        if not changed and self.last_edge is not None:
+            self.widths.append(edge_time - self.last_edge)
+        self.last_edge = edge_time
+        self.evaluations += 1
+        self.noisy += noisy
+        self.since_change += 1
+        self.noise += self.smoothing * ((1.0 if noisy else 0.0) - self.noise)
+        if self.since_change < self.settle:
+            return False
+        if self.noise > self.noisy_level:
+            return self._tune(self.bounce_time * 2, self.debouncer.required * 2)
+        if self.noise < self.clean_level:
+            return self._tune(self.bounce_time // 2, self.debouncer.required * 2 // 3)
+        return False
+
+    def _tune(self, bounce_time, required):
+        bounds = self.bounds
+        bounce_time = self._clamp(bounce_time, bounds.bounce_time_min, bounds.bounce_time_max)
+        required = self._clamp(required, bounds.required_min, bounds.required_max)
+        if bounce_time == self.bounce_time and required == self.debouncer.required:
+            return False
+        self.since_change = 0
+        self.changes += 1
+        if required != self.debouncer.required:
+            self.debouncer = self._debouncer(self.debouncer, required)
+        bounce_changed = bounce_time != self.bounce_time
+        self.bounce_time = bounce_time
+        return bounce_changed
+
+    def as_dict(self):
+        widths = sorted(self.widths)
+        debouncer = self.debouncer
+        return dict(pin=self.pin,
+                    bounce_time_ms=self.bounce_time,
+                    required_reads=debouncer.required,
+                    stable_time_ms=debouncer.required * debouncer.interval * 1000,
+                    noise=self.noise,
+                    glitch_rate=self.noisy / self.evaluations if self.evaluations else None,
+                    evaluations=self.evaluations,
+                    changes=self.changes,
+                    pulse_width_min_ms=widths[0] * 1000 if widths else None,
+                    pulse_width_median_ms=widths[len(widths) // 2] * 1000 if widths else None)
@@ -0,0 +1,203 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+from .debounce import Debouncer
+from .gcode import GcodeClassifier
+
+# lever switch, pin level tells if filament is present
+SENSOR_SWITCH = "switch"
+# motion (encoder) sensor, pulses while filament moves
+SENSOR_MOTION = "motion"
+
+# runout command is queued on the printer behind commands waiting to be sent
+DISPATCH_QUEUE = "queue"
+# runout command is put into the send queue ahead of the next line entering it, behind lines already queued
+DISPATCH_INJECT = "inject"
+
+
+class ReadOnly(object):
+    # snapshots are replaced as a whole on settings save so readers on the GPIO callback thread and the comm thread
+    # always see one consistent combination of values, they are never modified
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is read only" % self.__class__.__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError("%s is read only" % self.__class__.__name__)
+
+
+class SensorConfig(ReadOnly):
+    # configuration of one sensor
+    __slots__ = ("index", "name", "pin", "power", "triggered", "gcode", "debouncer", "type", "motion_window",
+                 "motion_pulses_per_mm")
+
+    def __init__(self, index, name, pin, power, triggered, gcode, debouncer=None, type=SENSOR_SWITCH,
+                 motion_window=20.0, motion_pulses_per_mm=0.1):
+        if type not in (SENSOR_SWITCH, SENSOR_MOTION):
+            raise ValueError("Unknown sensor type %s" % type)
+        init = super(ReadOnly, self).__setattr__
+        init("index", index)
+        init("name", name)
+        init("pin", int(pin))
+        init("power", int(power))
+        init("triggered", int(triggered))
+        init("gcode", gcode)
+        init("debouncer", debouncer or Debouncer())
+        init("type", type)
+        # mm of extrusion over which pulses of motion sensor are counted
+        init("motion_window", float(motion_window))
+        # less pulses per extruded mm over the window means a jam
+        init("motion_pulses_per_mm", float(motion_pulses_per_mm))
+
+    def __repr__(self):
+        return "SensorConfig(index=%s, name=%r, type=%s, pin=%s, power=%s, triggered=%s, gcode=%r)" % (
+            self.index, self.name, self.type, self.pin, self.power, self.triggered, self.gcode)
+
+    # sensor disabled if pin set to 0 (or -1 in old settings)
+    @property
+    def enabled(self):
+        return self.pin > 0
+
+
+class FilterBounds(ReadOnly):
+    # limits within which adaptive filtering tunes bounce time (milliseconds) and required stable reads
+    __slots__ = ("bounce_time_min", "bounce_time_max", "required_min", "required_max")
+
+    def __init__(self, bounce_time_min, bounce_time_max, required_min, required_max):
+        init = super(ReadOnly, self).__setattr__
+        init("bounce_time_min", max(1, int(bounce_time_min)))
+        init("bounce_time_max", max(self.bounce_time_min, int(bounce_time_max)))
+        init("required_min", max(1, int(required_min)))
+        init("required_max", max(self.required_min, int(required_max)))
+
+    def __repr__(self):
+        return "FilterBounds(bounce_time=%s-%s, required=%s-%s)" % (self.bounce_time_min, self.bounce_time_max,
+                                                                   self.required_min, self.required_max)
+
+
+class AlertConfig(ReadOnly):
+    # sinks of runout alerts, empty values disable them, and the printer name put into alerts
+    __slots__ = ("webhook_url", "command", "mqtt_topic", "timeout", "retries", "printer_name")
+
+    def __init__(self, webhook_url="", command="", mqtt_topic="", timeout=10, retries=5, printer_name=None):
+        init = super(ReadOnly, self).__setattr__
+        init("webhook_url", (webhook_url or "").strip())
+        init("command", (command or "").strip())
+        init("mqtt_topic", (mqtt_topic or "").strip())
+        # seconds a single delivery may take
+        init("timeout", max(1.0, float(timeout or 10)))
+        init("retries", max(0, int(retries or 0)))
+        # OctoPrint instance name, None if not set
+        init("printer_name", printer_name or None)
+
+    def __repr__(self):
+        return "AlertConfig(webhook_url=%r, command=%r, mqtt_topic=%r)" % (self.webhook_url, self.command,
+                                                                          self.mqtt_topic)
+
+
+class PluginConfig(ReadOnly):
+    # snapshot of all plugin settings, first sensor is the one configured by the original single sensor settings
+    __slots__ = ("gpio_backend", "gpio_mode", "cmd_action", "runout_dispatch", "filter_bounds", "poll_rate",
+                 "sd_status_interval", "publish_address", "publish_remote", "alerts", "sensors", "enabled_sensors", "switch_sensors",
+                 "motion_sensors", "by_pin", "gcode_classifier")
+
+    def __init__(self, gpio_mode, cmd_action, sensors, runout_dispatch=DISPATCH_QUEUE, filter_bounds=None,
+                 poll_rate=100, sd_status_interval=2, publish_address="", alerts=None, gpio_backend="rpi",
+                 publish_remote=False):
+        init = super(ReadOnly, self).__setattr__
+        # name of the GPIO backend, see gpio.create_backend
+        init("gpio_backend", gpio_backend or "rpi")
+        init("gpio_mode", int(gpio_mode))
+        init("cmd_action", int(cmd_action))
+        init("runout_dispatch", DISPATCH_INJECT if runout_dispatch == DISPATCH_INJECT else DISPATCH_QUEUE)
+        # None if adaptive filtering is off
+        init("filter_bounds", filter_bounds)
+        # passes per second of the polling sampler used for pins without edge detection
+        init("poll_rate", max(1.0, float(poll_rate or 100)))
+        # seconds between SD status autoreports, 0 leaves SD status polling to OctoPrint
+        init("sd_status_interval", max(0, int(sd_status_interval or 0)))
+        # address of the state publisher, empty if it is off
+        init("publish_address", (publish_address or "").strip())
+        # TCP publisher address may be other than loopback
+        init("publish_remote", bool(publish_remote))
+        init("alerts", alerts or AlertConfig())
+        init("sensors", tuple(sensors))
+        init("enabled_sensors", tuple(sensor for sensor in self.sensors if sensor.enabled))
+        init("switch_sensors", tuple(sensor for sensor in self.enabled_sensors if sensor.type == SENSOR_SWITCH))
+        init("motion_sensors", tuple(sensor for sensor in self.enabled_sensors if sensor.type == SENSOR_MOTION))
+        # edge dispatch, pin -> sensor
+        init("by_pin", dict((sensor.pin, sensor) for sensor in self.enabled_sensors))
+        init("gcode_classifier", GcodeClassifier(sensor.gcode for sensor in self.sensors))
+
+    def __repr__(self):
+        return "PluginConfig(gpio_mode=%s, cmd_action=%s, runout_dispatch=%s, sensors=%r)" % (
+            self.gpio_mode, self.cmd_action, self.runout_dispatch, self.sensors)
+
+    @property
+    def primary(self):
+        return self.sensors[0]
+
+    # plugin disabled if no sensor has a pin
+    @property
+    def enabled(self):
+        return len(self.enabled_sensors) > 0
+
+    @classmethod
+    def from_settings(cls, settings):
+        defaults = dict(pin=settings.get(["pin"]),
+                        power=settings.get(["power"]),
+                        triggered=settings.get(["triggered"]),
+                        g_code=settings.get(["g_code"]),
+                        debounce_mode=settings.get(["debounce_mode"]),
+                        debounce_samples=settings.get(["debounce_samples"]),
+                        debounce_required=settings.get(["debounce_required"]),
+                        debounce_interval=settings.get(["debounce_interval"]),
+                        debounce_deadline=settings.get(["debounce_deadline"]),
+                        motion_window=settings.get(["motion_window"]),
+                        motion_pulses_per_mm=settings.get(["motion_pulses_per_mm"]))
+        # first sensor is always a switch
+        sensors = [sensor_from_dict(0, defaults, defaults, "Filament")]
+        for values in settings.get(["sensors"]) or []:
+            sensors.append(sensor_from_dict(len(sensors), values, defaults, "Sensor %s" % (len(sensors) + 1)))
+        return cls(gpio_backend=settings.get(["gpio_backend"]),
+                   gpio_mode=settings.get(["gpio_mode"]),
+                   cmd_action=settings.get(["cmd_action"]),
+                   sensors=sensors,
+                   runout_dispatch=settings.get(["runout_dispatch"]),
+                   filter_bounds=FilterBounds(settings.get(["bounce_time_min"]), settings.get(["bounce_time_max"]),
+                                              settings.get(["debounce_required_min"]),
+                                              settings.get(["debounce_required_max"]))
+                   if settings.get_boolean(["adaptive_filter"]) else None,
+                   poll_rate=settings.get(["poll_rate"]),
+                   sd_status_interval=settings.get(["sd_status_interval"]),
+                   publish_address=settings.get(["publish_address"]),
+                   publish_remote=settings.get_boolean(["publish_remote"]),
+                   alerts=AlertConfig(settings.get(["notify_webhook_url"]), settings.get(["notify_command"]),
+                                      settings.get(["notify_mqtt_topic"]), settings.get(["notify_timeout"]),
+                                      settings.get(["notify_retries"]), settings.global_get(["appearance", "name"])))
+
+
+# missing values of additional sensors are taken from the first sensor
+def sensor_from_dict(index, values, defaults, default_name):
+    def value(key):
+        result = values.get(key)
+        if result is None or result == "":
+            return defaults.get(key)
+        return result
+
+    return SensorConfig(index=index,
+                        name=values.get("name") or default_name,
+                        pin=values.get("pin") or 0,
+                        power=value("power"),
+                        triggered=value("triggered"),
+                        gcode=value("g_code"),
+                        type=values.get("type") or SENSOR_SWITCH,
+                        motion_window=value("motion_window"),
+                        motion_pulses_per_mm=value("motion_pulses_per_mm"),
+                        # intervals are stored in milliseconds
+                        debouncer=Debouncer(mode=value("debounce_mode"),
+                                            samples=value("debounce_samples"),
+                                            required=value("debounce_required"),
+                                            interval=float(value("debounce_interval")) / 1000,
+                                            deadline=float(value("debounce_deadline")) / 1000))
@@ -0,0 +1,112 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import time
+
+monotonic = getattr(time, "monotonic", time.time)
+
+# required number of consecutive identical reads
+MODE_STABLE = "stable"
+# required number of identical reads out of all samples
+MODE_MAJORITY = "majority"
+
+
+class DebounceResult(object):
+    __slots__ = ("state", "samples", "glitches", "confidence", "timed_out", "first")
+
+    def __init__(self, state, samples, glitches, confidence, timed_out, first=None):
+        self.state = state
+        # number of reads taken
+        self.samples = samples
+        # number of changes between consecutive reads
+        self.glitches = glitches
+        # share of reads agreeing with decided state
+        self.confidence = confidence
+        # decision was forced by the deadline or by the sample limit
+        self.timed_out = timed_out
+        # first read, the raw value before debouncing
+        self.first = first
+
+    def __repr__(self):
+        return "DebounceResult(state=%s, samples=%s, glitches=%s, confidence=%.2f, timed_out=%s)" % (
+            self.state, self.samples, self.glitches, self.confidence, self.timed_out)
+
+
+class Debouncer(object):
+    # decides sensor state from repeated reads, bounded by number of samples and a hard deadline so it can never
+    # hang the thread it is called from, holds no state between decisions and can be shared by threads
+    __slots__ = ("mode", "samples", "required", "interval", "deadline")
+
+    def __init__(self, mode=MODE_STABLE, samples=50, required=10, interval=0.0, deadline=0.1):
+        if mode not in (MODE_STABLE, MODE_MAJORITY):
+            raise ValueError("Unknown debounce mode %s" % mode)
+        self.mode = mode
+        # maximum number of reads for one decision
+        self.samples = max(1, int(samples))
+        self.required = max(1, min(int(required), self.samples))
+        # seconds between two reads
+        self.interval = max(0.0, float(interval))
+        # seconds after which the decision is forced
+        self.deadline = max(0.0, float(deadline))
+
+    def decide(self, read):
+        if self.mode == MODE_MAJORITY:
+            return self._decide_majority(read)
+        return self._decide_stable(read)
+
+    def _decide_stable(self, read):
+        limit = self.samples
+        give_up = monotonic() + self.deadline
+        first = last = bool(read())
+        taken = 1
+        run = 1
+        glitches = 0
+        positive = 1 if last else 0
+        while run < self.required:
+            if taken >= limit or monotonic() >= give_up:
+                # deadline reached, decide by majority of everything read so far
+                state = positive * 2 >= taken
+                agreeing = positive if state else taken - positive
+                return DebounceResult(state, taken, glitches, float(agreeing) / taken, True, first)
+            if self.interval:
+                time.sleep(self.interval)
+            value = bool(read())
+            taken += 1
+            if value:
+                positive += 1
+            if value == last:
+                run += 1
+            else:
+                glitches += 1
+                last = value
+                run = 1
+        agreeing = positive if last else taken - positive
+        return DebounceResult(last, taken, glitches, float(agreeing) / taken, False, first)
+
+    def _decide_majority(self, read):
+        give_up = monotonic() + self.deadline
+        first = last = None
+        taken = 0
+        positive = 0
+        glitches = 0
+        timed_out = True
+        while taken < self.samples:
+            if taken and monotonic() >= give_up:
+                break
+            value = bool(read())
+            taken += 1
+            if value:
+                positive += 1
+            if last is None:
+                first = value
+            elif value != last:
+                glitches += 1
+            last = value
+            if positive >= self.required or taken - positive >= self.required:
+                timed_out = False
+                break
+            if self.interval:
+                time.sleep(self.interval)
+        state = positive * 2 >= taken
+        agreeing = positive if state else taken - positive
+        return DebounceResult(state, taken, glitches, float(agreeing) / taken, timed_out, first)
@@ -0,0 +1,132 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .metrics import Counter
+
+monotonic = getattr(time, "monotonic", time.time)
+
+
+class EdgeWorker(object):
+    # takes edges from the GPIO callback thread and evaluates them on its own thread, edges arriving in a burst
+    # are coalesced into one evaluation per pin
+
+    def __init__(self, handler, logger, maxsize=64, coalesce_time=0.01):
+        # handler(pin, first_edge_time, edge_count) is called on the worker thread
+        self._handler = handler
+        self._logger = logger
+        self._queue = queue.Queue(maxsize)
+        self._coalesce_time = coalesce_time
+        # pins whose edges didn't fit into the queue, they are evaluated with the next batch
+        self._dropped = {}
+        self._thread = None
+
+        # edges are submitted by the GPIO callback thread and the polling sampler, their counters are sharded by
+        # thread, the others are written by the worker thread only
+        self.received = Counter("edges_received_total", "Edges received from GPIO")
+        self.overflows = Counter("edges_overflows_total", "Edges which didn't fit into the edge queue")
+        self.coalesced = 0
+        self.evaluations = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="filamentsensorsimplified edge worker")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=1.0):
+        thread = self._thread
+        if thread is None:
+            return
+        self._thread = None
+        self._queue.put(None)
+        thread.join(timeout)
+
+    # called on the GPIO callback or sampler thread, must never block
+    def submit(self, pin):
+        self.received.inc()
+        now = monotonic()
+        try:
+            self._queue.put_nowait((pin, now))
+        except queue.Full:
+            self.overflows.inc()
+            self._dropped.setdefault(pin, now)
+
+    # blocks until all edges submitted so far were evaluated
+    def flush(self, timeout=None):
+        if self._thread is None:
+            return False
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def stats(self):
+        return dict(received=self.received.value,
+                    overflows=self.overflows.value,
+                    coalesced=self.coalesced,
+                    evaluations=self.evaluations,
+                    queued=self._queue.qsize())
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            edges = {}
+            markers = []
+            stop = self._collect(item, edges, markers)
+            if edges and self._coalesce_time:
+                # let the burst settle before evaluating
+                deadline = monotonic() + self._coalesce_time
+                while not stop:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    stop = self._collect(item, edges, markers)
+            while not stop:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                stop = self._collect(item, edges, markers)
+
+            for pin in list(self._dropped):
+                timestamp = self._dropped.pop(pin)
+                first, count = edges.get(pin, (timestamp, 0))
+                edges[pin] = (min(first, timestamp), count + 1)
+
+            for pin, (first, count) in edges.items():
+                self.coalesced += count - 1
+                self.evaluations += 1
+                try:
+                    self._handler(pin, first, count)
+                except Exception:
+                    self._logger.exception("Error while handling edge on pin %s" % pin)
+            for marker in markers:
+                marker.set()
+            if stop:
+                return
+
+    # returns True if the worker should stop
+    def _collect(self, item, edges, markers):
+        if item is None:
+            return True
+        if isinstance(item, tuple):
+            pin, timestamp = item
+            first, count = edges.get(pin, (timestamp, 0))
+            edges[pin] = (first, count + 1)
+        else:
+            markers.append(item)
+        return False
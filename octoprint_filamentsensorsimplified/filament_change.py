@@ -0,0 +1,196 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+from collections import deque
+
+from .debounce import monotonic
+
+# states of filament change, ordered so that later phases have higher numbers
+IDLE = 0
+# runout was decided, command not yet queued
+RUNOUT_DETECTED = 1
+# runout command has been queued on the printer
+COMMAND_QUEUED = 2
+# runout command or deliberate M600 has been sent to printer
+COMMAND_SENT = 3
+# printer is waiting for user to put in new filament
+PAUSED_FOR_USER = 4
+# printer finishes filament change, next sent line ends it
+RESUMING = 5
+
+STATE_NAMES = {IDLE: "idle",
+               RUNOUT_DETECTED: "runout_detected",
+               COMMAND_QUEUED: "command_queued",
+               COMMAND_SENT: "command_sent",
+               PAUSED_FOR_USER: "paused_for_user",
+               RESUMING: "resuming"}
+
+# events
+RUNOUT = "runout"
+QUEUED = "queued"
+# runout action was OctoPrint pause, there is no filament change to follow
+HOST_PAUSED = "host_paused"
+SENT = "sent"
+PAUSED = "paused"
+PROCESSING = "processing"
+LINE_SENT = "line_sent"
+
+TRANSITIONS = {
+    (IDLE, RUNOUT): RUNOUT_DETECTED,
+    (RUNOUT_DETECTED, QUEUED): COMMAND_QUEUED,
+    (RUNOUT_DETECTED, HOST_PAUSED): IDLE,
+    # deliberate M600
+    (IDLE, SENT): COMMAND_SENT,
+    (RUNOUT_DETECTED, SENT): COMMAND_SENT,
+    (COMMAND_QUEUED, SENT): COMMAND_SENT,
+    (COMMAND_SENT, PAUSED): PAUSED_FOR_USER,
+    (RESUMING, PAUSED): PAUSED_FOR_USER,
+    (PAUSED_FOR_USER, PROCESSING): RESUMING,
+    (PAUSED_FOR_USER, LINE_SENT): IDLE,
+    (RESUMING, LINE_SENT): IDLE,
+}
+
+
+class RunoutTrace(object):
+    # monotonic timestamps of one filament change, from sensor edge to printer pausing for user
+    __slots__ = ("sensor", "deliberate", "edge", "decision", "queued", "sent", "paused", "ended", "location")
+
+    def __init__(self, sensor=None, edge=None, decision=None, deliberate=False):
+        self.sensor = sensor
+        self.deliberate = deliberate
+        self.edge = edge
+        self.decision = decision
+        self.queued = None
+        self.sent = None
+        self.paused = None
+        self.ended = None
+        # layer, Z and file position of the print at runout if known
+        self.location = None
+
+    @staticmethod
+    def _ms(start, end):
+        if start is None or end is None:
+            return None
+        return (end - start) * 1000.0
+
+    def as_dict(self):
+        return dict(sensor=self.sensor,
+                    deliberate=self.deliberate,
+                    edge_to_decision_ms=self._ms(self.edge, self.decision),
+                    decision_to_queued_ms=self._ms(self.decision, self.queued),
+                    queued_to_sent_ms=self._ms(self.queued, self.sent),
+                    sent_to_paused_ms=self._ms(self.sent, self.paused),
+                    edge_to_paused_ms=self._ms(self.edge, self.paused),
+                    edge_to_sent_ms=self._ms(self.edge, self.sent),
+                    location=self.location)
+
+
+class FilamentChange(object):
+    # state of filament change shared by the edge worker, the comm thread and the event thread, every change goes
+    # through transition under one lock, reading state is lock free
+    trace_history = 20
+
+    def __init__(self, logger):
+        self._logger = logger
+        self._lock = threading.Lock()
+        self.state = IDLE
+        self.trace = None
+        self.traces = deque(maxlen=self.trace_history)
+        # runout command lines waiting to be put into the send queue ahead of the next queued line
+        self.injection = None
+
+    @property
+    def state_name(self):
+        return STATE_NAMES[self.state]
+
+    # filament change command has been queued or sent, the change has not necessarily started
+    @property
+    def initiated(self):
+        return self.state != IDLE
+
+    @property
+    def command_sent(self):
+        return self.state >= COMMAND_SENT
+
+    # printer started the filament change sequence
+    @property
+    def started(self):
+        return self.state >= PAUSED_FOR_USER
+
+    @property
+    def paused_for_user(self):
+        return self.state == PAUSED_FOR_USER
+
+    # returns True if the event changed state
+    def transition(self, event, timestamp=None, sensor=None):
+        with self._lock:
+            new_state = TRANSITIONS.get((self.state, event))
+            if new_state is None:
+                return False
+            timestamp = timestamp or monotonic()
+            old_state = self.state
+            trace = self.trace
+            if event == RUNOUT:
+                trace = self.trace = RunoutTrace(sensor=sensor, decision=timestamp)
+            elif trace is None:
+                trace = self.trace = RunoutTrace(deliberate=True)
+            if event == QUEUED or event == HOST_PAUSED:
+                trace.queued = timestamp
+            elif event == SENT:
+                trace.sent = timestamp
+            elif event == PAUSED and trace.paused is None:
+                trace.paused = timestamp
+            self.state = new_state
+            if new_state == IDLE:
+                self._finish(timestamp)
+        self._logger.debug("Filament change %s -> %s on %s" % (STATE_NAMES[old_state], STATE_NAMES[new_state], event))
+        return True
+
+    # starts filament change for runout detected by sensor, False if a change is already in progress
+    def begin_runout(self, sensor, edge_time=None, location=None):
+        now = monotonic()
+        if not self.transition(RUNOUT, now, sensor):
+            return False
+        self.trace.edge = edge_time if edge_time is not None else now
+        self.trace.location = location
+        return True
+
+    # queues runout command for injection, the state moves to command queued like for a command queued on printer
+    def queue_injection(self, commands):
+        with self._lock:
+            if self.state != RUNOUT_DETECTED:
+                return False
+            self.injection = list(commands)
+        return self.transition(QUEUED)
+
+    # returns injected commands exactly once, the caller has to send them, None if there is nothing to inject
+    def take_injection(self):
+        with self._lock:
+            commands = self.injection
+            self.injection = None
+            return commands
+
+    # back to idle on print start, end or error
+    def reset(self):
+        with self._lock:
+            if self.state != IDLE:
+                self._logger.debug("Filament change reset from %s" % STATE_NAMES[self.state])
+                self.state = IDLE
+                self._finish(monotonic())
+
+    def _finish(self, timestamp):
+        self.injection = None
+        trace = self.trace
+        self.trace = None
+        if trace is None:
+            return
+        trace.ended = timestamp
+        self.traces.append(trace)
+        if trace.paused is not None or trace.queued is not None:
+            self._logger.info("Runout latency: %s" % ", ".join("%s=%.1f" % (key, value) for key, value in
+                                                                sorted(trace.as_dict().items())
+                                                                if isinstance(value, float)))
+
+    def recent_traces(self):
+        return [trace.as_dict() for trace in list(self.traces)]
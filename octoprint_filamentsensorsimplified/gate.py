@@ -0,0 +1,73 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+
+# gate states
+WAITING = 0
+OPEN = 1
+HELD = 2
+
+STATE_NAMES = {WAITING: "waiting", OPEN: "open", HELD: "held"}
+
+# tags OctoPrint puts on lines of a print job, the start script is sent before the first file line
+JOB_TAGS = frozenset(("source:file", "script:beforePrintStarted"))
+
+
+# True if line with given tags belongs to a print job
+def is_job_line(tags):
+    return bool(tags) and not JOB_TAGS.isdisjoint(tags)
+
+
+class JobGate(object):
+    # decides once per job whether it may start, from last known sensor states only so the decision never reads GPIO,
+    # the comm thread (first line of the job) and the event thread (print started) both ask, whichever comes first
+    # decides and the other gets the same answer
+    __slots__ = ("_lock", "state", "sensor", "hold_requested", "on_hold")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.state = WAITING
+        # sensor without filament which held the job
+        self.sensor = None
+        # OctoPrint was asked to stop reading lines of the held job, at most once per job
+        self.hold_requested = False
+        # job is on hold until the plugin releases it
+        self.on_hold = False
+
+    # missing() returns sensor without filament or None, returns (state, True if this call decided)
+    def decide(self, missing):
+        with self._lock:
+            if self.state != WAITING:
+                return self.state, False
+            self.sensor = missing()
+            self.state = HELD if self.sensor is not None else OPEN
+            return self.state, True
+
+    # True once per held job, the caller puts the job on hold then
+    def hold(self):
+        with self._lock:
+            if self.state != HELD or self.hold_requested:
+                return False
+            self.hold_requested = self.on_hold = True
+            return True
+
+    # True if the job was put on hold and not released yet, the caller releases it then, the job isn't put on hold
+    # after it was released
+    def release(self):
+        with self._lock:
+            on_hold = self.on_hold
+            self.on_hold = False
+            self.hold_requested = True
+            return on_hold
+
+    # next job is checked again
+    def reset(self):
+        with self._lock:
+            self.state = WAITING
+            self.sensor = None
+            self.hold_requested = False
+
+    @property
+    def state_name(self):
+        return STATE_NAMES[self.state]
@@ -0,0 +1,110 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# prefix of filament change command, also used for the sending hook fast path
+FILAMENT_CHANGE_PREFIX = "M600"
+# M113 - host keepalive message
+KEEPALIVE_PREFIX = "M113"
+
+# flags returned by GcodeClassifier.classify, a line can be of more kinds at once (e.g. runout command M600 X0 Y0)
+OTHER = 0
+RUNOUT_COMMAND = 1
+FILAMENT_CHANGE = 2
+KEEPALIVE = 4
+
+
+class GcodeClassifier(object):
+    # classifies outgoing lines the plugin reacts to, built once on settings load/save so the sending hook
+    # doesn't have to read settings or run regular expressions for every line
+    __slots__ = ("runout_gcodes", "_runout_kinds")
+
+    def __init__(self, runout_gcodes):
+        # every sensor can have its own runout command
+        self._runout_kinds = dict((gcode, RUNOUT_COMMAND | self._classify_prefix(gcode))
+                                  for gcode in runout_gcodes if gcode)
+        self.runout_gcodes = frozenset(self._runout_kinds)
+
+    @staticmethod
+    def _classify_prefix(cmd):
+        if cmd.startswith(FILAMENT_CHANGE_PREFIX):
+            return FILAMENT_CHANGE
+        if cmd.startswith(KEEPALIVE_PREFIX):
+            return KEEPALIVE
+        return OTHER
+
+    def classify(self, cmd):
+        kind = self._runout_kinds.get(cmd)
+        if kind is not None:
+            return kind
+        return self._classify_prefix(cmd)
+
+
+# moves which can extrude
+MOVE_GCODES = frozenset(("G0", "G1", "G2", "G3"))
+
+
+# value of parameter like E in "G1 X10 E1.5 F1800" or None, one pass over the line without regular expressions
+def parameter(cmd, letter):
+    index = cmd.find(letter, 1)
+    while index != -1:
+        if cmd[index - 1] == " ":
+            end = cmd.find(" ", index)
+            try:
+                return float(cmd[index + 1:end] if end != -1 else cmd[index + 1:])
+            except ValueError:
+                return None
+        index = cmd.find(letter, index + 1)
+    return None
+
+
+# lines of configured g-code setting, without comments and empty lines
+def split_commands(gcode):
+    commands = []
+    for line in (gcode or "").splitlines():
+        line = line.split(";", 1)[0].strip()
+        if line:
+            commands.append(line)
+    return commands
+
+
+class ExtrusionTracker(object):
+    # follows E axis position from sent lines, handles G90/G91 positioning, M82/M83 extruder mode and G92 resets
+    __slots__ = ("relative_positioning", "relative_extrusion", "position")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # G91 makes all axes relative including E, M83 only E
+        self.relative_positioning = False
+        self.relative_extrusion = False
+        self.position = 0.0
+
+    # returns mm of filament pushed forward by the line, gcode is the command code OctoPrint parsed from the line
+    def feed(self, gcode, cmd):
+        if gcode in MOVE_GCODES:
+            e = parameter(cmd, "E")
+            if e is None:
+                return 0.0
+            if self.relative_positioning or self.relative_extrusion:
+                self.position += e
+                return e if e > 0 else 0.0
+            delta = e - self.position
+            self.position = e
+            return delta if delta > 0 else 0.0
+        if gcode == "G92":
+            e = parameter(cmd, "E")
+            if e is not None:
+                self.position = e
+            elif parameter(cmd, "X") is None and parameter(cmd, "Y") is None and parameter(cmd, "Z") is None:
+                # G92 without parameters resets all axes
+                self.position = 0.0
+        elif gcode == "G90":
+            self.relative_positioning = False
+        elif gcode == "G91":
+            self.relative_positioning = True
+        elif gcode == "M82":
+            self.relative_extrusion = False
+        elif gcode == "M83":
+            self.relative_extrusion = True
+        return 0.0
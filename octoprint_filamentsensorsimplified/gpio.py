@@ -0,0 +1,328 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import random
+import threading
+import time
+
+try:
+    from importlib.util import find_spec
+except ImportError:
+    find_spec = None
+
+monotonic = getattr(time, "monotonic", time.time)
+
+# data pins of the 40 pin header in BOARD numbering, other pins are power or ground
+BOARD_DATA_PINS = (3, 5, 7, 11, 13, 15, 19, 21, 23, 27, 29, 31, 33, 35, 37,
+                   8, 10, 12, 16, 18, 22, 24, 26, 28, 32, 36, 38, 40)
+# highest pin number in BCM numbering
+BCM_MAX_PIN = 27
+
+
+class GPIOBackend(object):
+    # interface of GPIO access used by the plugin, constants have the same values as in RPi.GPIO
+    name = None
+
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def setwarnings(self, flag):
+        raise NotImplementedError()
+
+    def getmode(self):
+        raise NotImplementedError()
+
+    def setmode(self, mode):
+        raise NotImplementedError()
+
+    def setup(self, pin, direction, pull_up_down=None):
+        raise NotImplementedError()
+
+    def input(self, pin):
+        raise NotImplementedError()
+
+    # levels of given pins read in one pass
+    def input_many(self, pins):
+        return [self.input(pin) for pin in pins]
+
+    # True if pin was set up in this process, by the plugin or by another plugin, RPi.GPIO reads only such pins
+    def is_setup(self, pin):
+        try:
+            self.input(pin)
+        except RuntimeError:
+            return False
+        return True
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        raise NotImplementedError()
+
+    def remove_event_detect(self, pin):
+        raise NotImplementedError()
+
+    def gpio_function(self, pin):
+        raise NotImplementedError()
+
+    # resets given pin or all pins and the numbering mode
+    def cleanup(self, pin=None):
+        raise NotImplementedError()
+
+
+class RPiGPIOBackend(GPIOBackend):
+    name = "rpi"
+
+    def __init__(self):
+        # imported only when this backend is used so the plugin can be imported on any machine
+        import RPi.GPIO as GPIO
+        if GPIO.VERSION < "0.6":
+            raise RuntimeError("RPi.GPIO %s found, at least 0.6 is needed for edge detection" % GPIO.VERSION)
+        self._gpio = GPIO
+        for constant in ("BOARD", "BCM", "OUT", "IN", "PUD_DOWN", "PUD_UP", "RISING", "FALLING", "BOTH"):
+            setattr(self, constant, getattr(GPIO, constant))
+
+    def setwarnings(self, flag):
+        self._gpio.setwarnings(flag)
+
+    def getmode(self):
+        return self._gpio.getmode()
+
+    def setmode(self, mode):
+        self._gpio.setmode(mode)
+
+    def setup(self, pin, direction, pull_up_down=None):
+        if pull_up_down is None:
+            self._gpio.setup(pin, direction)
+        else:
+            self._gpio.setup(pin, direction, pull_up_down=pull_up_down)
+
+    def input(self, pin):
+        return self._gpio.input(pin)
+
+    # RPi.GPIO has no bank read, the loop at least saves a method call per pin
+    def input_many(self, pins):
+        read = self._gpio.input
+        return [read(pin) for pin in pins]
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        kwargs = dict(callback=callback)
+        if bouncetime:
+            kwargs["bouncetime"] = bouncetime
+        self._gpio.add_event_detect(pin, edge, **kwargs)
+
+    def remove_event_detect(self, pin):
+        self._gpio.remove_event_detect(pin)
+
+    def gpio_function(self, pin):
+        return self._gpio.gpio_function(pin)
+
+    def cleanup(self, pin=None):
+        if pin is None:
+            self._gpio.cleanup()
+        else:
+            self._gpio.cleanup(pin)
+
+
+class SimulatedGPIOBackend(GPIOBackend):
+    # GPIO without hardware, pin levels are set directly or played back from a timeline of
+    # (seconds, pin, level) entries, edge callbacks are called like RPi.GPIO does including bounce time filtering
+    name = "simulated"
+
+    def __init__(self, functions=None):
+        self._lock = threading.RLock()
+        self._mode = None
+        # pin -> usage reported by gpio_function for pins used by others
+        self._functions = dict(functions or {})
+        self._pulls = {}
+        self._levels = {}
+        # pin -> [edge, callback, bouncetime in seconds, time of last callback]
+        self._detections = {}
+        # time of the last level change, follows the timeline during playback
+        self.time = 0.0
+        self.reads = 0
+        # False makes add_event_detect fail like on kernels without edge detection support
+        self.edge_detection = True
+
+    def setwarnings(self, flag):
+        pass
+
+    def getmode(self):
+        return self._mode
+
+    def setmode(self, mode):
+        if mode not in (self.BOARD, self.BCM):
+            raise ValueError("An invalid mode was passed to setmode()")
+        if self._mode is not None and self._mode != mode:
+            raise ValueError("A different mode has already been set!")
+        self._mode = mode
+
+    def _check_pin(self, pin):
+        if self._mode is None:
+            raise RuntimeError("Please set pin numbering mode using GPIO.setmode(GPIO.BOARD) or GPIO.setmode(GPIO.BCM)")
+        if self._mode == self.BOARD and pin not in BOARD_DATA_PINS:
+            raise ValueError("The channel sent is invalid on a Raspberry Pi")
+        if self._mode == self.BCM and not 0 <= pin <= BCM_MAX_PIN:
+            raise ValueError("The channel sent is invalid on a Raspberry Pi")
+
+    def setup(self, pin, direction, pull_up_down=None):
+        with self._lock:
+            self._check_pin(pin)
+            self._pulls[pin] = pull_up_down
+            self._functions.pop(pin, None)
+
+    def input(self, pin):
+        with self._lock:
+            if pin not in self._pulls:
+                raise RuntimeError("You must setup() the GPIO channel first")
+            self.reads += 1
+            return self._level(pin)
+
+    def input_many(self, pins):
+        with self._lock:
+            for pin in pins:
+                if pin not in self._pulls:
+                    raise RuntimeError("You must setup() the GPIO channel first")
+            self.reads += len(pins)
+            return [self._level(pin) for pin in pins]
+
+    def _level(self, pin):
+        level = self._levels.get(pin)
+        if level is None:
+            # floating pin follows its pull resistor
+            return 0 if self._pulls.get(pin) == self.PUD_DOWN else 1
+        return level
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        with self._lock:
+            if pin not in self._pulls:
+                raise RuntimeError("You must setup() the GPIO channel first")
+            if not self.edge_detection:
+                raise RuntimeError("Failed to add edge detection")
+            if pin in self._detections:
+                raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+            self._detections[pin] = [edge, callback, (bouncetime or 0) / 1000.0, None]
+
+    def remove_event_detect(self, pin):
+        with self._lock:
+            self._detections.pop(pin, None)
+
+    def gpio_function(self, pin):
+        with self._lock:
+            self._check_pin(pin)
+            if pin in self._pulls:
+                return self.IN
+            return self._functions.get(pin, self.IN)
+
+    def cleanup(self, pin=None):
+        with self._lock:
+            if pin is not None:
+                self._pulls.pop(pin, None)
+                self._detections.pop(pin, None)
+                return
+            self._mode = None
+            self._pulls.clear()
+            self._detections.clear()
+
+    # sets pin level as if changed by the sensor at simulation time at, or now on the monotonic clock, calls edge
+    # callback on the calling thread
+    def set_level(self, pin, level, at=None):
+        with self._lock:
+            self.time = at if at is not None else monotonic()
+            old = self._level(pin) if pin in self._pulls else self._levels.get(pin)
+            self._levels[pin] = level
+            detection = self._detections.get(pin)
+            if detection is None or old is None or old == level:
+                return
+            edge, callback, bouncetime, last = detection
+            if edge == self.RISING and level != 1 or edge == self.FALLING and level != 0:
+                return
+            if last is not None and self.time - last < bouncetime:
+                return
+            detection[3] = self.time
+        if callback is not None:
+            callback(pin)
+
+    # plays back timeline of (seconds, pin, level), speed 1 is real time, 0 as fast as possible
+    def play(self, timeline, speed=1.0, blocking=True):
+        events = sorted(timeline, key=lambda event: event[0])
+
+        def run():
+            start = monotonic()
+            for at, pin, level in events:
+                if speed:
+                    delay = start + at / speed - monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                self.set_level(pin, level, at=at)
+
+        if blocking:
+            run()
+            return None
+        thread = threading.Thread(target=run, name="simulated gpio playback")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+# timeline of level change to level at given time with bouncing contacts before it settles
+def bounce(at, pin, level, bounces=5, period=0.0005):
+    events = []
+    for i in range(bounces * 2):
+        events.append((at + i * period, pin, level if i % 2 == 0 else 1 - level))
+    events.append((at + bounces * 2 * period, pin, level))
+    return events
+
+
+# timeline of short spikes away from level between start and end
+def noise(start, end, pin, level, rate=50.0, width=0.0002, seed=0):
+    rnd = random.Random(seed)
+    events = []
+    at = start + rnd.expovariate(rate)
+    while at < end:
+        events.append((at, pin, 1 - level))
+        events.append((at + width, pin, level))
+        at += width + rnd.expovariate(rate)
+    return events
+
+
+backends = dict(rpi=RPiGPIOBackend, simulated=SimulatedGPIOBackend)
+
+
+def create_backend(name):
+    backend = backends.get(name)
+    if backend is None:
+        raise ValueError("Unknown GPIO backend %s" % name)
+    return backend()
+
+
+# pins worth probing in given numbering mode
+def candidate_pins(gpio_mode):
+    if gpio_mode == GPIOBackend.BCM:
+        return tuple(range(1, BCM_MAX_PIN + 1))
+    return BOARD_DATA_PINS
+
+
+# whether module can be imported, checked without importing it (importing RPi.GPIO is slow and touches the hardware)
+def module_available(name):
+    if find_spec is not None:
+        try:
+            return find_spec(name) is not None
+        except ImportError:
+            return False
+    # Python 2
+    import imp
+    path = None
+    for part in name.split("."):
+        try:
+            module = imp.find_module(part, path)
+        except ImportError:
+            return False
+        if module[0] is not None:
+            module[0].close()
+        path = [module[1]]
+    return True
@@ -0,0 +1,177 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import io
+import json
+import os
+import threading
+import time
+from collections import deque
+
+# event types
+RUNOUT = "runout"
+JAM = "jam"
+REMOVED = "removed"
+INSERTED = "inserted"
+# edge after which the debounced state didn't change
+BOUNCE = "bounce"
+# filament change ended, printer continues
+RECOVERED = "recovered"
+PRINT_CANCELLED = "print_cancelled"
+
+
+class EventHistory(object):
+    # sensor events kept in a fixed size ring buffer and appended to a size rotated journal in the plugin data
+    # folder, the journal is written in batches by its own thread so recording never touches the disk
+    journal_name = "events.log"
+
+    def __init__(self, folder, logger, capacity=200, journal_size=256 * 1024, journal_count=4, flush_interval=2.0):
+        self._folder = folder
+        self._logger = logger
+        self.path = os.path.join(folder, self.journal_name)
+        self.journal_size = journal_size
+        self.journal_count = journal_count
+        self.flush_interval = flush_interval
+        self.events = deque(maxlen=capacity)
+        # events waiting to be written, bounded so a stalled disk can't grow memory
+        self._pending = deque(maxlen=capacity * 4)
+        self._seq_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._running = False
+        self.seq = self._last_seq()
+        self.dropped = 0
+        self.written = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="filamentsensorsimplified journal")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=1.0):
+        thread = self._thread
+        if thread is None:
+            return
+        self._thread = None
+        self._running = False
+        self._wake.set()
+        thread.join(timeout)
+        self.flush()
+
+    def record(self, type, sensor=None, raw=None, present=None, glitches=0, job=None, action=None, location=None):
+        with self._seq_lock:
+            self.seq += 1
+            event = dict(seq=self.seq, time=time.time(), type=type,
+                         sensor=sensor.name if sensor is not None else None,
+                         pin=sensor.pin if sensor is not None else None,
+                         raw=raw, present=present, glitches=glitches, job=job, action=action, location=location)
+            self.events.append(event)
+            if len(self._pending) == self._pending.maxlen:
+                self.dropped += 1
+            self._pending.append(event)
+        return event
+
+    def _run(self):
+        while self._running:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    # writes pending events to the journal
+    def flush(self):
+        with self._write_lock:
+            if not self._pending:
+                return
+            lines = []
+            while self._pending:
+                try:
+                    lines.append(json.dumps(self._pending.popleft(), sort_keys=True))
+                except IndexError:
+                    break
+            try:
+                with io.open(self.path, "ab") as f:
+                    f.write(("\n".join(lines) + "\n").encode("utf-8"))
+                    size = f.tell()
+                self.written += len(lines)
+                if size >= self.journal_size:
+                    self._rotate()
+            except (IOError, OSError) as e:
+                self._logger.warning("Could not write event journal %s: %s" % (self.path, e))
+
+    def _rotate(self):
+        for index in range(self.journal_count - 1, 0, -1):
+            source = self.path if index == 1 else "%s.%d" % (self.path, index - 1)
+            target = "%s.%d" % (self.path, index)
+            if os.path.exists(source):
+                os.rename(source, target)
+
+    # journal files from the oldest
+    def _files(self):
+        files = ["%s.%d" % (self.path, index) for index in range(self.journal_count - 1, 0, -1)]
+        files.append(self.path)
+        return [path for path in files if os.path.exists(path)]
+
+    def _last_seq(self):
+        for path in reversed(self._files()):
+            try:
+                with io.open(path, "rb") as f:
+                    f.seek(0, os.SEEK_END)
+                    f.seek(max(0, f.tell() - 4096))
+                    tail = f.read().decode("utf-8", "replace").splitlines()
+                for line in reversed(tail):
+                    try:
+                        return int(json.loads(line)["seq"])
+                    except (ValueError, KeyError, TypeError):
+                        continue
+            except (IOError, OSError):
+                continue
+        return 0
+
+    # events with seq above after, oldest first, filtered by time range and types, and the cursor of the next page
+    # or None, answered from memory when the ring buffer reaches back far enough, otherwise the journal is streamed
+    def query(self, after=0, limit=100, since=None, until=None, types=None):
+        def matches(event):
+            return (event["seq"] > after
+                    and (since is None or event["time"] >= since)
+                    and (until is None or event["time"] <= until)
+                    and (not types or event["type"] in types))
+
+        events = list(self.events)
+        if events and events[0]["seq"] <= after + 1:
+            source = iter(events)
+        else:
+            self.flush()
+            source = self._stream()
+        page = []
+        for event in source:
+            if until is not None and event["time"] > until:
+                break
+            if matches(event):
+                if len(page) == limit:
+                    return page, page[-1]["seq"]
+                page.append(event)
+        return page, None
+
+    def _stream(self):
+        with self._write_lock:
+            # open all files at once, a rotation while reading doesn't affect open files
+            handles = []
+            for path in self._files():
+                try:
+                    handles.append(io.open(path, "r", encoding="utf-8"))
+                except (IOError, OSError):
+                    continue
+        try:
+            for handle in handles:
+                for line in handle:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+        finally:
+            for handle in handles:
+                handle.close()
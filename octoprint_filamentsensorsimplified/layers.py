@@ -0,0 +1,229 @@
+# coding=utf-8
+from __future__ import absolute_import, division
+
+import hashlib
+import io
+import mmap
+import os
+import re
+import struct
+import threading
+from array import array
+from bisect import bisect_right
+
+from .debounce import monotonic
+
+# Z parameter, group 1 is the height, searched without anchoring to the line start so the literal prefix lets the
+# regular expression engine skip to candidates quickly
+Z_PARAMETER = re.compile(br" Z(-?[0-9]*\.?[0-9]+)")
+# start of a line up to a Z parameter which belongs to a move, not to a comment or other command
+MOVE_PREFIX = re.compile(br"G[0-3](?:[ \t][^\n;]*)?$")
+# move extruding along X or Y, retracts and travel moves don't match
+EXTRUSION = re.compile(br"^G[1-3](?=[ \t])[^\n;]*?[ \t][XY][^\n;]*?[ \t]E\.?[0-9]", re.MULTILINE)
+
+
+class LayerIndex(object):
+    # file offsets where layers start and their heights, offsets are ascending so a file position is looked up by
+    # binary search
+    __slots__ = ("offsets", "heights")
+
+    def __init__(self, offsets, heights):
+        self.offsets = offsets
+        self.heights = heights
+
+    def __len__(self):
+        return len(self.offsets)
+
+    # layer the line at file position belongs to or None for lines before the first layer
+    def locate(self, filepos):
+        index = bisect_right(self.offsets, filepos) - 1
+        if index < 0:
+            return None
+        return dict(layer=index + 1, layers=len(self.offsets), z=self.heights[index],
+                    layer_offset=self.offsets[index], filepos=filepos)
+
+
+# scans G-code file for layer changes, a layer starts at a move changing Z by at least min_step which is followed by
+# an extrusion before the next Z move, so Z hops and travel moves between objects are not counted, returns None
+# if cancelled
+def build_index(path, cancelled=None, min_step=0.02):
+    offsets = array("l")
+    heights = array("d")
+    with io.open(path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return LayerIndex(offsets, heights)
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            layer_z = None
+            candidate = None
+            # a candidate is decided when the next Z move is found, the regular expressions do the scanning so only
+            # lines setting Z are seen by Python
+            for match in Z_PARAMETER.finditer(data):
+                position = match.start()
+                line_start = data.rfind(b"\n", 0, position) + 1
+                if MOVE_PREFIX.match(data, line_start, position) is None:
+                    continue
+                if candidate is not None:
+                    layer_z = _add_layer(data, candidate, line_start, layer_z, min_step, offsets, heights)
+                    if cancelled is not None and cancelled():
+                        return None
+                try:
+                    candidate = (line_start, float(match.group(1)))
+                except ValueError:
+                    candidate = None
+            if candidate is not None:
+                _add_layer(data, candidate, len(data), layer_z, min_step, offsets, heights)
+        finally:
+            data.close()
+    return LayerIndex(offsets, heights)
+
+
+def _add_layer(data, candidate, end, layer_z, min_step, offsets, heights):
+    start, z = candidate
+    if layer_z is not None and abs(z - layer_z) < min_step:
+        return layer_z
+    # the Z move itself can extrude (spiral vase)
+    if EXTRUSION.search(data, start, end) is None:
+        return layer_z
+    offsets.append(start)
+    heights.append(z)
+    return z
+
+
+class LayerIndexCache(object):
+    # layer indexes stored in the plugin data folder by file hash, the least recently used are removed over capacity
+    magic = b"FSLI"
+    version = 1
+    header = struct.Struct("<4sBBBI")
+
+    def __init__(self, folder, logger, capacity=20):
+        self._folder = folder
+        self._logger = logger
+        self.capacity = capacity
+
+    def _path(self, key):
+        # keys are hex digests, anything else is dropped so a key can't leave the folder
+        return os.path.join(self._folder, "%s.idx" % "".join(c for c in key if c.isalnum()))
+
+    def load(self, key):
+        path = self._path(key)
+        try:
+            with io.open(path, "rb") as f:
+                magic, version, offset_size, height_size, count = self.header.unpack(f.read(self.header.size))
+                offsets = array("l")
+                heights = array("d")
+                if (magic, version, offset_size, height_size) != (self.magic, self.version, offsets.itemsize,
+                                                                  heights.itemsize):
+                    return None
+                offsets.fromfile(f, count)
+                heights.fromfile(f, count)
+            # mark as recently used
+            os.utime(path, None)
+            return LayerIndex(offsets, heights)
+        except (IOError, OSError, EOFError, struct.error):
+            return None
+
+    def store(self, key, index):
+        try:
+            if not os.path.isdir(self._folder):
+                os.makedirs(self._folder)
+            path = self._path(key)
+            with io.open(path + ".tmp", "wb") as f:
+                f.write(self.header.pack(self.magic, self.version, index.offsets.itemsize, index.heights.itemsize,
+                                         len(index)))
+                index.offsets.tofile(f)
+                index.heights.tofile(f)
+            # os.rename doesn't replace on Windows
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(path + ".tmp", path)
+            self._prune()
+        except (IOError, OSError) as e:
+            self._logger.warning("Could not store layer index %s: %s" % (key, e))
+
+    def _prune(self):
+        files = [os.path.join(self._folder, name) for name in os.listdir(self._folder) if name.endswith(".idx")]
+        if len(files) <= self.capacity:
+            return
+        files.sort(key=os.path.getmtime)
+        for path in files[:len(files) - self.capacity]:
+            os.remove(path)
+
+
+# cache key of a file without a known hash, changes when the file is replaced
+def file_key(path):
+    stat = os.stat(path)
+    return hashlib.sha1(("%s:%s:%s" % (path, stat.st_size, stat.st_mtime)).encode("utf-8")).hexdigest()
+
+
+class LayerIndexer(object):
+    # builds layer index of the printed file on its own thread so print start is never held up, only the index of
+    # the current job is kept, a build for a job which ended meanwhile is thrown away
+    def __init__(self, folder, logger, capacity=20):
+        self._logger = logger
+        self.cache = LayerIndexCache(folder, logger, capacity)
+        self._lock = threading.Lock()
+        self._job = 0
+        self.index = None
+        # counters, written by build threads one at a time
+        self.builds = 0
+        self.cache_hits = 0
+        self.failures = 0
+        self.build_time = None
+
+    # file_hash() is called on the build thread and returns hash of the file or None
+    def start(self, path, file_hash=None):
+        with self._lock:
+            self._job += 1
+            job = self._job
+            self.index = None
+        thread = threading.Thread(target=self._build, args=(job, path, file_hash),
+                                  name="filamentsensorsimplified layer index")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def cancel(self):
+        with self._lock:
+            self._job += 1
+            self.index = None
+
+    def _build(self, job, path, file_hash):
+        cancelled = lambda: self._job != job
+        try:
+            key = (file_hash() if file_hash is not None else None) or file_key(path)
+            start = monotonic()
+            index = self.cache.load(key)
+            cached = index is not None
+            if cached:
+                self.cache_hits += 1
+            else:
+                index = build_index(path, cancelled)
+                if index is None:
+                    return
+                self.builds += 1
+                self.build_time = monotonic() - start
+                self.cache.store(key, index)
+            self._logger.info("Layer index of %s has %s layers, %s in %.1f ms"
+                              % (path, len(index), "loaded" if cached else "built", (monotonic() - start) * 1000))
+            with self._lock:
+                if self._job == job:
+                    self.index = index
+        except Exception:
+            self.failures += 1
+            self._logger.exception("Could not build layer index of %s" % path)
+
+    # location of file position in the current job or None if the index isn't ready
+    def locate(self, filepos):
+        index = self.index
+        if index is None or filepos is None:
+            return None
+        return index.locate(filepos)
+
+    def stats(self):
+        index = self.index
+        return dict(layers=len(index) if index is not None else None,
+                    builds=self.builds,
+                    cache_hits=self.cache_hits,
+                    failures=self.failures,
+                    build_time=self.build_time)
@@ -0,0 +1,158 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+from collections import deque
+
+from .debounce import monotonic
+
+
+class MessageBroadcaster(object):
+    # sends plugin messages to all clients, every message type is rate limited by a token bucket and messages over the
+    # limit wait for tokens: a state message replaces any older pending message of its type so the last state always
+    # reaches clients and identical state messages within repeat_window are dropped, other messages (pop-ups) are
+    # queued in order and never dropped as repeats, a client connecting later must get them again
+    repeat_window = 5.0
+
+    # type -> (messages per second, burst)
+    limits = {"filamentStatus": (2.0, 5)}
+    default_limit = (0.5, 3)
+
+    # types whose newest message supersedes older ones
+    coalesced = frozenset(("filamentStatus",))
+
+    # pop-ups waiting for tokens per type, more are dropped
+    max_pending = 20
+
+    def __init__(self, send, logger):
+        # send(data) delivers message to clients
+        self._send = send
+        self._logger = logger
+        self._lock = threading.Lock()
+        # type -> [tokens, time of last refill]
+        self._buckets = {}
+        # type -> (key, time) of last sent message
+        self._last = {}
+        # type -> deque of (data, key) waiting for tokens, at most one for coalesced types
+        self._pending = {}
+        self._timers = {}
+        # type -> dict of counters
+        self._counters = {}
+
+    def _count(self, message_type, name):
+        counters = self._counters.get(message_type)
+        if counters is None:
+            counters = self._counters[message_type] = dict(sent=0, repeats=0, rate_limited=0, unchanged=0, delayed=0,
+                                                           overflow=0)
+        counters[name] += 1
+
+    # state message which would not change anything on clients, counted only
+    def suppress_unchanged(self, message_type):
+        with self._lock:
+            self._count(message_type, "unchanged")
+
+    def send(self, data):
+        message_type = data.get("type")
+        key = repr(sorted(data.items()))
+        now = monotonic()
+        with self._lock:
+            last = self._last.get(message_type)
+            pending = self._pending.get(message_type)
+            if pending and message_type in self.coalesced:
+                # older pending message is superseded, it never reaches clients
+                self._count(message_type, "rate_limited")
+                if last is not None and last[0] == key:
+                    # clients already show this message
+                    del self._pending[message_type]
+                else:
+                    pending[0] = (data, key)
+                return False
+            if pending:
+                # pop-ups keep their order behind those already waiting
+                self._queue(message_type, data, key, pending)
+                return False
+            if message_type in self.coalesced and last is not None and last[0] == key \
+                    and now - last[1] < self.repeat_window:
+                self._count(message_type, "repeats")
+                return False
+            if not self._take_token(message_type, now):
+                self._queue(message_type, data, key, None)
+                self._schedule(message_type, now)
+                return False
+            self._last[message_type] = (key, now)
+            self._count(message_type, "sent")
+        self._deliver(data)
+        return True
+
+    # called with the lock held
+    def _queue(self, message_type, data, key, pending):
+        if pending is None:
+            pending = self._pending[message_type] = deque()
+        elif pending[-1][1] == key:
+            self._count(message_type, "repeats")
+            return
+        elif len(pending) >= self.max_pending:
+            self._count(message_type, "overflow")
+            self._logger.warning("Too many %s messages waiting, dropping %s" % (message_type, data.get("msg")))
+            return
+        if message_type not in self.coalesced:
+            self._count(message_type, "delayed")
+        pending.append((data, key))
+
+    def _take_token(self, message_type, now):
+        rate, burst = self.limits.get(message_type, self.default_limit)
+        bucket = self._buckets.get(message_type)
+        if bucket is None:
+            bucket = self._buckets[message_type] = [float(burst), now]
+        bucket[0] = min(float(burst), bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] < 1.0:
+            return False
+        bucket[0] -= 1.0
+        return True
+
+    def _schedule(self, message_type, now):
+        if message_type in self._timers:
+            return
+        rate, burst = self.limits.get(message_type, self.default_limit)
+        delay = (1.0 - self._buckets[message_type][0]) / rate
+        timer = threading.Timer(max(0.0, delay), self._flush, args=(message_type,))
+        timer.daemon = True
+        self._timers[message_type] = timer
+        timer.start()
+
+    def _flush(self, message_type):
+        now = monotonic()
+        with self._lock:
+            self._timers.pop(message_type, None)
+            pending = self._pending.get(message_type)
+            if not pending:
+                return
+            if not self._take_token(message_type, now):
+                self._schedule(message_type, now)
+                return
+            data, key = pending.popleft()
+            if pending:
+                self._schedule(message_type, now)
+            else:
+                del self._pending[message_type]
+            self._last[message_type] = (key, now)
+            self._count(message_type, "sent")
+        self._deliver(data)
+
+    def _deliver(self, data):
+        try:
+            self._send(data)
+        except Exception:
+            self._logger.exception("Error while sending plugin message")
+
+    def cancel(self):
+        with self._lock:
+            for timer in self._timers.values():
+                timer.cancel()
+            self._timers.clear()
+            self._pending.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict((message_type, dict(counters)) for message_type, counters in self._counters.items())
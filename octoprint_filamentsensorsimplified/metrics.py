@@ -0,0 +1,150 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+from bisect import bisect_left
+
+try:
+    from threading import get_ident
+except ImportError:
+    from thread import get_ident
+
+# upper bounds in seconds of hook duration histograms
+HOOK_BUCKETS = (0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+                0.0025, 0.01)
+# upper bounds in seconds of runout command dispatch histogram
+DISPATCH_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# upper bounds in seconds of polling sampler wake up lateness histogram
+JITTER_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+
+class Counter(object):
+    # counter without lock, every thread increments its own shard and a scrape sums them, a thread only ever writes
+    # its own key so increments from the GPIO, comm and worker threads never overwrite each other
+    __slots__ = ("name", "help", "_shards")
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._shards = {}
+
+    def inc(self, amount=1):
+        shards = self._shards
+        key = get_ident()
+        shards[key] = shards.get(key, 0) + amount
+
+    @property
+    def value(self):
+        return sum(list(self._shards.values()))
+
+    def render(self, lines):
+        lines.append("# HELP %s %s" % (self.name, self.help))
+        lines.append("# TYPE %s counter" % self.name)
+        lines.append("%s %s" % (self.name, self.value))
+
+
+class Histogram(object):
+    # histogram with fixed buckets sharded by thread like Counter, shard is a list of bucket counts followed by the
+    # count of values above the last bucket and the sum of all values
+    __slots__ = ("name", "help", "buckets", "_shards")
+
+    def __init__(self, name, help, buckets=HOOK_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._shards = {}
+
+    def observe(self, value):
+        key = get_ident()
+        shard = self._shards.get(key)
+        if shard is None:
+            shard = self._shards[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        shard[bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def snapshot(self):
+        # bucket counts (not cumulative) including the overflow bucket and sum
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0.0
+        for shard in list(self._shards.values()):
+            shard = list(shard)
+            for index in range(len(counts)):
+                counts[index] += shard[index]
+            total += shard[-1]
+        return counts, total
+
+    def render(self, lines):
+        counts, total = self.snapshot()
+        lines.append("# HELP %s %s" % (self.name, self.help))
+        lines.append("# TYPE %s histogram" % self.name)
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append('%s_bucket{le="%s"} %s' % (self.name, format_value(bound), cumulative))
+        cumulative += counts[-1]
+        lines.append('%s_bucket{le="+Inf"} %s' % (self.name, cumulative))
+        lines.append("%s_sum %s" % (self.name, format_value(total)))
+        lines.append("%s_count %s" % (self.name, cumulative))
+
+
+def format_value(value):
+    if value is None:
+        return "NaN"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+# metric set by the scrape from values kept elsewhere, samples are (labels dict, value)
+def render_gauge(lines, name, help, samples, type="gauge"):
+    lines.append("# HELP %s %s" % (name, help))
+    lines.append("# TYPE %s %s" % (name, type))
+    for labels, value in samples:
+        if labels:
+            label_text = ",".join('%s="%s"' % (key, escape_label(labels[key])) for key in sorted(labels))
+            lines.append("%s{%s} %s" % (name, label_text, format_value(value)))
+        else:
+            lines.append("%s %s" % (name, format_value(value)))
+
+
+class Metrics(object):
+    # counters updated by the plugin, values kept by other objects (edge worker, sensor states) are read at scrape
+    prefix = "filamentsensorsimplified_"
+
+    def __init__(self):
+        prefix = self.prefix
+        self.debounce_samples = Counter(prefix + "debounce_samples_total", "Sensor reads taken by the debouncer")
+        self.debounce_glitches = Counter(prefix + "debounce_glitches_total",
+                                         "Changes between consecutive debouncer reads")
+        self.debounce_timeouts = Counter(prefix + "debounce_timeouts_total",
+                                         "Debouncer decisions forced by deadline or sample limit")
+        self.repeats = Counter(prefix + "false_positive_repeats_total",
+                               "Edge evaluations which did not change the debounced sensor state")
+        self.runouts = Counter(prefix + "runouts_total", "Runout actions fired")
+        self.jobs_held = Counter(prefix + "jobs_held_total",
+                                 "Print jobs held back before their first line because a sensor had no filament")
+        self.injections = Counter(prefix + "runout_injections_total",
+                                  "Runout commands injected ahead of queued lines")
+        self.injection_fallbacks = Counter(prefix + "runout_injection_fallbacks_total",
+                                           "Runout commands queued on printer because no line was sent in time")
+        self.runout_dispatch = Histogram(prefix + "runout_dispatch_seconds",
+                                         "Time from queueing the runout command to sending it", DISPATCH_BUCKETS)
+        self.sending_gcode = Histogram(prefix + "sending_gcode_seconds",
+                                       "Time spent in the gcode sending hook, sampled every n-th call")
+        self.gcode_received = Histogram(prefix + "gcode_received_seconds",
+                                        "Time spent in the gcode received hook, sampled every n-th call")
+        self.sampler_jitter = Histogram(prefix + "sampler_jitter_seconds",
+                                        "Lateness of polling sampler passes behind their schedule", JITTER_BUCKETS)
+        self.counters = (self.debounce_samples, self.debounce_glitches, self.debounce_timeouts, self.repeats,
+                         self.runouts, self.jobs_held, self.injections, self.injection_fallbacks)
+        self.histograms = (self.sending_gcode, self.gcode_received, self.runout_dispatch, self.sampler_jitter)
+
+    def render(self, lines):
+        for counter in self.counters:
+            counter.render(lines)
+        for histogram in self.histograms:
+            histogram.render(lines)
+        return lines
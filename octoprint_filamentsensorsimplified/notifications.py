@@ -0,0 +1,203 @@
+# coding=utf-8
+from __future__ import absolute_import, division
+
+import json
+import random
+import threading
+from collections import OrderedDict
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class NotificationError(Exception):
+    # delivery failed, retried unless permanent
+    def __init__(self, message, permanent=False):
+        super(NotificationError, self).__init__(message)
+        self.permanent = permanent
+
+
+class WebhookSink(object):
+    # posts notification as JSON
+    name = "webhook"
+
+    def __init__(self, url, timeout=10.0):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, payload):
+        # imported on first delivery, urllib pulls in http, email and ssl modules OctoPrint startup doesn't need
+        try:
+            from urllib.request import Request, urlopen
+        except ImportError:
+            from urllib2 import Request, urlopen
+        request = Request(self.url, data=json.dumps(payload).encode("utf-8"),
+                          headers={"Content-Type": "application/json"})
+        response = urlopen(request, timeout=self.timeout)
+        try:
+            status = response.getcode()
+        finally:
+            response.close()
+        if not 200 <= status < 300:
+            raise NotificationError("%s answered %s" % (self.url, status))
+
+
+class CommandSink(object):
+    # runs shell command with notification as JSON on standard input, killed after timeout
+    name = "command"
+
+    def __init__(self, command, timeout=10.0):
+        self.command = command
+        self.timeout = timeout
+
+    def send(self, payload):
+        import subprocess
+        process = subprocess.Popen(self.command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        # Popen.communicate has no timeout on Python 2
+        timer = threading.Timer(self.timeout, process.kill)
+        timer.daemon = True
+        timer.start()
+        try:
+            output = process.communicate(json.dumps(payload).encode("utf-8"))[0]
+        finally:
+            timer.cancel()
+        if process.returncode:
+            raise NotificationError("%s exited with %s: %s" % (self.command, process.returncode,
+                                                               output.decode("utf-8", "replace").strip()[:200]))
+
+
+class MqttSink(object):
+    # publishes notification through the MQTT plugin, if it is installed
+    name = "mqtt"
+
+    def __init__(self, plugin_manager, topic):
+        self._plugin_manager = plugin_manager
+        self.topic = topic
+
+    def send(self, payload):
+        helpers = self._plugin_manager.get_helpers("mqtt", "mqtt_publish")
+        if not helpers or "mqtt_publish" not in helpers:
+            raise NotificationError("MQTT plugin is not installed", permanent=True)
+        helpers["mqtt_publish"](self.topic, json.dumps(payload))
+
+
+class NotificationDispatcher(object):
+    # delivers notifications to sinks on a pool of worker threads, notify never blocks: a full queue drops the
+    # notification, failed deliveries are retried with exponential backoff and a notification with a key already
+    # seen is not sent again
+    def __init__(self, logger, workers=2, max_queue=100, retries=5, backoff=2.0, max_backoff=300.0, remember=200):
+        self._logger = logger
+        self.sinks = ()
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._queue = queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        # keys of recent notifications
+        self._seen = OrderedDict()
+        self._remember = remember
+        self._threads = []
+        self._timers = set()
+        # counters, guarded by the lock
+        self.counters = dict(queued=0, sent=0, retries=0, failed=0, dropped=0, duplicates=0)
+
+    def start(self):
+        if self._threads:
+            return
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name="filamentsensorsimplified notifications %d" % index)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=1.0):
+        threads = self._threads
+        self._threads = []
+        with self._lock:
+            for timer in self._timers:
+                timer.cancel()
+            self._timers.clear()
+        for _ in threads:
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                break
+        for thread in threads:
+            thread.join(timeout)
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    # hands notification over to the workers, key identifies the event it is about, returns False if it was dropped
+    def notify(self, key, payload):
+        sinks = self.sinks
+        if not sinks or not self._threads:
+            return False
+        with self._lock:
+            if key in self._seen:
+                self.counters["duplicates"] += 1
+                return False
+            self._seen[key] = True
+            if len(self._seen) > self._remember:
+                self._seen.popitem(last=False)
+        queued = True
+        for sink in sinks:
+            queued = self._put((sink, key, payload, 0)) and queued
+        return queued
+
+    def _put(self, job):
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            self._count("dropped")
+            self._logger.warning("Notification queue full, %s notification %s dropped" % (job[0].name, job[1]))
+            return False
+        self._count("queued")
+        return True
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            sink, key, payload, attempt = job
+            try:
+                sink.send(payload)
+            except Exception as e:
+                self._failed(job, e)
+            else:
+                self._count("sent")
+                self._logger.debug("Notification %s sent to %s" % (key, sink.name))
+
+    def _failed(self, job, error):
+        sink, key, payload, attempt = job
+        if attempt >= self.retries or getattr(error, "permanent", False):
+            self._count("failed")
+            self._logger.warning("Notification %s to %s failed: %s" % (key, sink.name, error))
+            return
+        # full jitter so that notifications failing together don't retry together
+        delay = random.uniform(0.5, 1.0) * min(self.max_backoff, self.backoff * 2 ** attempt)
+        self._logger.info("Notification %s to %s failed (%s), retrying in %.1f s" % (key, sink.name, error, delay))
+        self._count("retries")
+        timer = threading.Timer(delay, self._retry, args=((sink, key, payload, attempt + 1),))
+        timer.daemon = True
+        with self._lock:
+            if not self._threads:
+                return
+            self._timers.add(timer)
+        timer.start()
+
+    def _retry(self, job):
+        with self._lock:
+            self._timers.discard(threading.current_thread())
+        if self._threads:
+            self._put(job)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, queue=self._queue.qsize(), pending_retries=len(self._timers))
@@ -0,0 +1,265 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import errno
+import json
+import os
+import select
+import socket
+import stat
+import struct
+import threading
+from collections import deque
+
+# 4 byte big endian length of the JSON record which follows
+LENGTH = struct.Struct(">I")
+
+
+# "unix:/path/to/socket" or "tcp:host:port", returns (family, address) or raises ValueError, TCP hosts other than
+# loopback only if allow_remote
+def parse_address(address, allow_remote=False):
+    kind, _, rest = address.partition(":")
+    if kind == "unix" and rest:
+        if not hasattr(socket, "AF_UNIX"):
+            raise ValueError("Unix domain sockets are not supported on this platform")
+        return socket.AF_UNIX, rest
+    if kind == "tcp" and rest:
+        host, _, port = rest.rpartition(":")
+        try:
+            port = int(port)
+        except ValueError:
+            port = None
+        if port is not None:
+            host = host or "127.0.0.1"
+            if not allow_remote and not is_loopback(host):
+                raise ValueError("Publisher address %s is not a loopback address, allow other hosts to use it"
+                                 % address)
+            return socket.AF_INET, (host, port)
+    raise ValueError("Invalid publisher address %s, use unix:<path> or tcp:<host>:<port>" % address)
+
+
+def is_loopback(host):
+    return host == "localhost" or host.startswith("127.")
+
+
+# removes socket left behind at path by a previous run, raises ValueError if something else is there
+def remove_socket(path):
+    try:
+        mode = os.lstat(path).st_mode
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return
+        raise
+    if not stat.S_ISSOCK(mode):
+        raise ValueError("%s exists and is not a socket, not replacing it" % path)
+    os.remove(path)
+
+
+def encode(record):
+    payload = json.dumps(record, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    return LENGTH.pack(len(payload)) + payload
+
+
+class Subscriber(object):
+    __slots__ = ("sock", "name", "buffer")
+
+    def __init__(self, sock, name):
+        self.sock = sock
+        self.name = name
+        # bytes not yet taken by the socket
+        self.buffer = bytearray()
+
+
+class StatePublisher(object):
+    # pushes length prefixed JSON records to every connected subscriber of a local socket, publish never blocks: records
+    # are handed to the publisher thread which writes to non-blocking sockets, a subscriber whose unsent data grows
+    # over max_buffer is disconnected instead of holding up the others
+    def __init__(self, address, logger, snapshot=None, max_buffer=64 * 1024, max_queue=1024, allow_remote=False):
+        self.name = address
+        self.allow_remote = allow_remote
+        self.family, self.address = parse_address(address, allow_remote)
+        self._logger = logger
+        # snapshot() returns records sent to a new subscriber first, called on the publisher thread
+        self._snapshot = snapshot
+        self.max_buffer = max_buffer
+        self._queue = deque(maxlen=max_queue)
+        self._subscribers = {}
+        self._listener = None
+        self._wake_read, self._wake_write = socket.socketpair()
+        self._wake_read.setblocking(False)
+        self._wake_write.setblocking(False)
+        self._thread = None
+        self._running = False
+        # counters, written by the publisher thread except published and queue_overflows
+        self.published = 0
+        self.queue_overflows = 0
+        self.connected = 0
+        self.dropped = 0
+        self.sent_bytes = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        listener = socket.socket(self.family, socket.SOCK_STREAM)
+        try:
+            if self.family == socket.AF_UNIX:
+                remove_socket(self.address)
+            else:
+                listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind(self.address)
+            listener.listen(16)
+            listener.setblocking(False)
+        except (socket.error, OSError, ValueError):
+            listener.close()
+            raise
+        self._listener = listener
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="filamentsensorsimplified publisher")
+        self._thread.daemon = True
+        self._thread.start()
+        self._logger.info("Publishing sensor states on %s" % (self.address,))
+
+    def stop(self, timeout=1.0):
+        thread = self._thread
+        if thread is None:
+            return
+        self._thread = None
+        self._running = False
+        self._wake()
+        thread.join(timeout)
+
+    # called from any thread, never blocks
+    def publish(self, record):
+        if self._thread is None:
+            return
+        if len(self._queue) == self._queue.maxlen:
+            self.queue_overflows += 1
+        self._queue.append(encode(record))
+        self.published += 1
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wake_write.send(b"\0")
+        except socket.error:
+            # wake up pipe is full, the thread is going to run anyway
+            pass
+
+    def _run(self):
+        try:
+            while self._running:
+                subscribers = self._subscribers
+                readable = [self._listener, self._wake_read] + list(subscribers)
+                writable = [sock for sock, subscriber in subscribers.items() if subscriber.buffer]
+                try:
+                    readable, writable, _ = select.select(readable, writable, [])
+                except (select.error, OSError, ValueError) as e:
+                    self._logger.debug("Publisher select failed: %s" % (e,))
+                    continue
+                for sock in readable:
+                    if sock is self._listener:
+                        self._accept()
+                    elif sock is self._wake_read:
+                        self._drain_wake()
+                    else:
+                        self._read(sock)
+                self._dispatch()
+                for sock in writable:
+                    if sock in self._subscribers:
+                        self._flush(self._subscribers[sock])
+        finally:
+            for subscriber in list(self._subscribers.values()):
+                self._drop(subscriber, "publisher stopped")
+            self._listener.close()
+            self._wake_read.close()
+            self._wake_write.close()
+            if self.family == socket.AF_UNIX:
+                try:
+                    remove_socket(self.address)
+                except (OSError, ValueError) as e:
+                    self._logger.warning("Could not remove publisher socket: %s" % (e,))
+
+    def _accept(self):
+        try:
+            sock, address = self._listener.accept()
+        except socket.error:
+            return
+        sock.setblocking(False)
+        subscriber = Subscriber(sock, address or "unix")
+        self._subscribers[sock] = subscriber
+        self.connected += 1
+        self._logger.debug("Subscriber %s connected" % (subscriber.name,))
+        if self._snapshot is not None:
+            try:
+                for record in self._snapshot():
+                    subscriber.buffer += encode(record)
+            except Exception:
+                self._logger.exception("Error while building sensor state snapshot")
+        self._flush(subscriber)
+
+    def _drain_wake(self):
+        try:
+            while self._wake_read.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    # subscribers don't send anything, data is discarded and end of stream means they left
+    def _read(self, sock):
+        subscriber = self._subscribers.get(sock)
+        if subscriber is None:
+            return
+        try:
+            data = sock.recv(4096)
+        except socket.error as e:
+            if e.args and e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = None
+        if not data:
+            self._drop(subscriber, "disconnected")
+
+    def _dispatch(self):
+        while self._queue:
+            try:
+                data = self._queue.popleft()
+            except IndexError:
+                break
+            for subscriber in list(self._subscribers.values()):
+                if len(subscriber.buffer) + len(data) > self.max_buffer:
+                    self._drop(subscriber, "too slow")
+                    continue
+                subscriber.buffer += data
+                self._flush(subscriber)
+
+    def _flush(self, subscriber):
+        if not subscriber.buffer:
+            return
+        try:
+            sent = subscriber.sock.send(subscriber.buffer)
+        except socket.error as e:
+            if e.args and e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self._drop(subscriber, "send failed: %s" % (e,))
+            return
+        self.sent_bytes += sent
+        del subscriber.buffer[:sent]
+
+    def _drop(self, subscriber, reason):
+        if self._subscribers.pop(subscriber.sock, None) is None:
+            return
+        if reason != "disconnected" and reason != "publisher stopped":
+            self.dropped += 1
+        self._logger.debug("Subscriber %s dropped: %s" % (subscriber.name, reason))
+        try:
+            subscriber.sock.close()
+        except socket.error:
+            pass
+
+    def stats(self):
+        return dict(address=self.name,
+                    subscribers=len(self._subscribers),
+                    published=self.published,
+                    queue_overflows=self.queue_overflows,
+                    connected=self.connected,
+                    dropped=self.dropped,
+                    sent_bytes=self.sent_bytes)
@@ -0,0 +1,159 @@
+# coding=utf-8
+from __future__ import absolute_import, division
+
+import threading
+import time
+
+monotonic = getattr(time, "monotonic", time.time)
+# CPU time of the calling thread, Python 3.7+
+thread_time = getattr(time, "thread_time", None)
+
+
+class PollingSampler(object):
+    # fallback for pins where edge detection can't be enabled, one thread reads all watched pins in one pass at a
+    # fixed rate and reports level changes to the same callback GPIO edge detection would call, so polled pins go
+    # through the edge worker, debouncer and sensor states like any other pin
+
+    def __init__(self, read_pins, callback, logger, rate=100.0, jitter=None):
+        # read_pins(pins) returns levels of pins in the same order, callback(pin) is called on the sampler thread
+        self._read_pins = read_pins
+        self._callback = callback
+        self._logger = logger
+        self._jitter = jitter
+        self.period = 1.0 / rate
+        # replaced as a whole, the sampler thread takes it once per pass
+        self._pins = ()
+        # pin -> last read level, None until the first read
+        self._levels = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._running = False
+
+        # counters, written by the sampler thread only
+        self.passes = 0
+        self.reads = 0
+        self.changes = 0
+        self.errors = 0
+        # passes started a whole period late, schedule is moved forward instead of catching up
+        self.overruns = 0
+        self.jitter_max = 0.0
+        self.jitter_total = 0.0
+        self.cpu_time = 0.0
+        self.run_time = 0.0
+
+    @property
+    def pins(self):
+        return self._pins
+
+    @property
+    def rate(self):
+        return 1.0 / self.period
+
+    @rate.setter
+    def rate(self, rate):
+        self.period = 1.0 / rate
+
+    def watch(self, pin):
+        with self._lock:
+            if pin not in self._pins:
+                self._levels[pin] = None
+                self._pins = self._pins + (pin,)
+        self.start()
+        self._wake.set()
+
+    def unwatch(self, pin):
+        with self._lock:
+            if pin in self._pins:
+                self._pins = tuple(watched for watched in self._pins if watched != pin)
+                self._levels.pop(pin, None)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="filamentsensorsimplified sampler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=1.0):
+        thread = self._thread
+        if thread is None:
+            return
+        self._thread = None
+        self._running = False
+        self._wake.set()
+        thread.join(timeout)
+
+    def _run(self):
+        scheduled = None
+        while self._running:
+            pins = self._pins
+            if not pins:
+                # idle until a pin is watched, idle time isn't counted in the CPU usage
+                self._wake.wait()
+                self._wake.clear()
+                scheduled = None
+                continue
+            now = monotonic()
+            if scheduled is None:
+                scheduled = now
+            else:
+                late = now - scheduled
+                self.jitter_total += late
+                if late > self.jitter_max:
+                    self.jitter_max = late
+                if self._jitter is not None:
+                    self._jitter.observe(late)
+                if late >= self.period:
+                    self.overruns += 1
+                    scheduled = now
+                self.run_time += now - started
+                if cpu_started is not None:
+                    self.cpu_time += thread_time() - cpu_started
+            started = now
+            cpu_started = thread_time() if thread_time is not None else None
+            self._sample(pins)
+            scheduled += self.period
+            delay = scheduled - monotonic()
+            if delay > 0:
+                # sleep is precise on Python 2 too, unlike waiting on an event with timeout
+                time.sleep(delay)
+
+    def _sample(self, pins):
+        self.passes += 1
+        try:
+            levels = self._read_pins(pins)
+        except Exception as e:
+            # pins can be cleaned up by settings save while being read
+            self.errors += 1
+            self._logger.debug("Polling pins %s failed: %s" % (pins, e))
+            return
+        self.reads += len(pins)
+        last = self._levels
+        for pin, level in zip(pins, levels):
+            previous = last.get(pin)
+            if previous == level:
+                continue
+            last[pin] = level
+            if previous is None:
+                continue
+            self.changes += 1
+            try:
+                self._callback(pin)
+            except Exception:
+                self._logger.exception("Error while handling level change on pin %s" % pin)
+
+    def stats(self):
+        passes = self.passes
+        run_time = self.run_time
+        return dict(pins=list(self._pins),
+                    rate=self.rate,
+                    passes=passes,
+                    reads=self.reads,
+                    changes=self.changes,
+                    errors=self.errors,
+                    overruns=self.overruns,
+                    jitter_mean_ms=self.jitter_total / passes * 1000 if passes else None,
+                    jitter_max_ms=self.jitter_max * 1000,
+                    cpu_percent=self.cpu_time / run_time * 100 if run_time and thread_time is not None else None)
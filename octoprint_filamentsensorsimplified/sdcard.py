@@ -0,0 +1,72 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# firmware responses about SD card printing, checked by one startswith call per received line
+PROGRESS_PREFIX = "SD printing byte "
+DONE_PREFIX = "Done printing file"
+NOT_PRINTING_PREFIX = "Not SD printing"
+AUTOREPORT_PREFIX = "Cap:AUTOREPORT_SD_STATUS:"
+SD_PREFIXES = (PROGRESS_PREFIX, DONE_PREFIX, NOT_PRINTING_PREFIX, AUTOREPORT_PREFIX)
+
+# events returned by SdPrintTracker.feed
+STARTED = "started"
+ADVANCED = "advanced"
+DONE = "done"
+STOPPED = "stopped"
+AUTOREPORT = "autoreport"
+
+
+class SdPrintTracker(object):
+    # follows SD card print from status responses the firmware sends anyway (M27 polled by OctoPrint or autoreported),
+    # only ever fed by the comm thread
+    __slots__ = ("active", "position", "size", "autoreport", "autoreport_enabled")
+
+    def __init__(self):
+        self.active = False
+        self.position = None
+        self.size = None
+        # firmware can report SD status by itself (M27 S<seconds>)
+        self.autoreport = False
+        # autoreport was switched on for the current print
+        self.autoreport_enabled = False
+
+    def feed(self, line):
+        if line.startswith(PROGRESS_PREFIX):
+            try:
+                position, size = line[len(PROGRESS_PREFIX):].split("/", 1)
+                position = int(position)
+                size = int(size)
+            except ValueError:
+                return None
+            previous = self.position
+            self.position = position
+            self.size = size
+            if not self.active:
+                # printer reports the position of a paused print too, it is printing once the position moves
+                if previous is not None and position > previous:
+                    self.active = True
+                    return STARTED
+                return None
+            return ADVANCED if previous is None or position > previous else None
+        if line.startswith(DONE_PREFIX):
+            self.reset()
+            return DONE
+        if line.startswith(NOT_PRINTING_PREFIX):
+            if self.active:
+                self.active = False
+                return STOPPED
+            return None
+        if line.startswith(AUTOREPORT_PREFIX):
+            self.autoreport = line[len(AUTOREPORT_PREFIX):].strip() == "1"
+            return AUTOREPORT
+        return None
+
+    def reset(self):
+        self.active = False
+        self.position = None
+        self.size = None
+        self.autoreport_enabled = False
+
+    def as_dict(self):
+        return dict(active=self.active, position=self.position, size=self.size, autoreport=self.autoreport,
+                    autoreport_enabled=self.autoreport_enabled)
@@ -0,0 +1,109 @@
+# coding=utf-8
+from __future__ import absolute_import, division
+
+import threading
+import time
+
+
+class SensorState(object):
+    # last known state of one sensor, written only by the thread evaluating its edges
+    __slots__ = ("pin", "present", "changed", "edges", "glitches")
+
+    def __init__(self, pin):
+        self.pin = pin
+        # None until first read
+        self.present = None
+        # monotonic time of last change of present
+        self.changed = None
+        self.edges = 0
+        self.glitches = 0
+
+    def update(self, present, timestamp, glitches=0):
+        changed = present != self.present
+        if changed:
+            self.present = present
+            self.changed = timestamp
+        self.glitches += glitches
+        return changed
+
+
+# per sensor status sent to clients and returned by API
+def sensor_status(sensor, state):
+    return dict(name=sensor.name,
+                pin=sensor.pin,
+                noFilament=None if state is None or state.present is None else not state.present)
+
+
+class MotionMonitor(object):
+    # compares pulses of a motion (encoder) sensor with expected filament movement over a sliding window of
+    # extruded mm, the window is split into buckets so it slides without keeping every line
+    __slots__ = ("pin", "min_pulses_per_mm", "bucket_mm", "buckets", "pulses", "bucket_start", "bucket_extruded",
+                 "window_extruded", "window_pulses", "rate")
+
+    bucket_count = 4
+
+    def __init__(self, pin, window_mm, min_pulses_per_mm):
+        self.pin = pin
+        self.min_pulses_per_mm = min_pulses_per_mm
+        self.bucket_mm = float(window_mm) / self.bucket_count
+        # pulses are counted on the GPIO callback thread, everything else on the comm thread
+        self.pulses = 0
+        self.reset()
+
+    def reset(self):
+        self.buckets = []
+        self.bucket_start = self.pulses
+        self.bucket_extruded = 0.0
+        self.window_extruded = 0.0
+        self.window_pulses = 0
+        # pulses per mm of last full window or None
+        self.rate = None
+
+    # adds extruded mm, returns None until window is full then whether the filament moves as expected
+    def extruded(self, mm):
+        self.bucket_extruded += mm
+        if self.bucket_extruded < self.bucket_mm:
+            return None
+        pulses = self.pulses
+        bucket = (self.bucket_extruded, pulses - self.bucket_start)
+        self.bucket_start = pulses
+        self.bucket_extruded = 0.0
+        self.buckets.append(bucket)
+        self.window_extruded += bucket[0]
+        self.window_pulses += bucket[1]
+        if len(self.buckets) > self.bucket_count:
+            oldest = self.buckets.pop(0)
+            self.window_extruded -= oldest[0]
+            self.window_pulses -= oldest[1]
+        elif len(self.buckets) < self.bucket_count:
+            return None
+        self.rate = self.window_pulses / self.window_extruded
+        return self.rate >= self.min_pulses_per_mm
+
+
+class StatusCache(object):
+    # last known status of all sensors served to clients and the status route, rebuilt only when a sensor state
+    # changes so answering a client never reads GPIO, status dict is replaced as a whole and never modified
+    __slots__ = ("_lock", "generation", "version", "status")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # distinguishes versions of different plugin runs
+        self.generation = "%x" % int(time.time() * 1000)
+        self.version = 0
+        self.status = dict(version=0, noFilament=False, printing=False, sensors=[])
+
+    # entity tag of given status taken from this cache
+    def etag(self, status):
+        return '"%s-%s"' % (self.generation, status["version"])
+
+    # returns True if the status changed
+    def publish(self, sensors, printing):
+        no_filament = any(status["noFilament"] for status in sensors)
+        with self._lock:
+            status = self.status
+            if status["sensors"] == sensors and status["printing"] == printing:
+                return False
+            self.version += 1
+            self.status = dict(version=self.version, noFilament=no_filament, printing=printing, sensors=sensors)
+        return True
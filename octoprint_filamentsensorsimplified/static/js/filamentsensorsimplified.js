@@ -5,6 +5,8 @@ $(function () {
         self.validPinsBoard = [3,5,7,11,13,15,19,21,23,27,29,31,33,35,37,8,10,12,16,18,22,24,26,28,32,36,38,40];
         self.settingsViewModel = parameters[0];
         self.testSensorResult = ko.observable(null);
+        self.scanResult = ko.observableArray([]);
+        self.scanning = ko.observable(false);
         self.gpio_mode_disabled = ko.observable(false);
         self.printing = ko.observable(false);
         self.gpio_mode_disabled_by_3rd = ko.computed(function() {
@@ -18,7 +20,7 @@ $(function () {
 
             // Update icon
             if (data.type == "filamentStatus"){
-                self.updateIconStatus(data.noFilament);
+                self.updateIconStatus(data.noFilament, data.sensors);
                 return;
             }
 
@@ -31,14 +33,58 @@ $(function () {
 
         }
 
-        self.updateIconStatus = function(noFilament){
+        self.updateIconStatus = function(noFilament, sensors){
+            var title = noFilament ? 'Filament NOT detected' : 'Filament detected';
+            // With more sensors list state of each of them
+            if (sensors && sensors.length > 1){
+                title = $.map(sensors, function(sensor){
+                    return sensor.name + ': ' + (sensor.noFilament ? 'filament NOT detected' : 'filament detected');
+                }).join('\n');
+            }
             if (noFilament){
-                $('#navbar_plugin_filamentsensorsimplified a').html('<i class="fas fa-life-ring fa-lg red-color"></i>').attr('title','Filament NOT detected');
+                $('#navbar_plugin_filamentsensorsimplified a').html('<i class="fas fa-life-ring fa-lg red-color"></i>').attr('title',title);
             } else {
-                $('#navbar_plugin_filamentsensorsimplified a').html('<i class="fas fa-life-ring fa-lg green-color"></i>').attr('title','Filament detected');
+                $('#navbar_plugin_filamentsensorsimplified a').html('<i class="fas fa-life-ring fa-lg green-color"></i>').attr('title',title);
             }
         }
 
+        // Icon status from last known sensor state, unchanged state is answered with 304
+        self.fetchStatus = function(){
+            $.ajax({
+                type: "GET",
+                dataType: "json",
+                url: "plugin/filamentsensorsimplified/status",
+                ifModified: true,
+                success: function (result, textStatus) {
+                    if (textStatus === "notmodified" || !result || !result.sensors.length) {
+                        return;
+                    }
+                    self.updateIconStatus(result.noFilament, result.sensors);
+                }
+            });
+        }
+
+        self.onStartupComplete = self.fetchStatus;
+        self.onDataUpdaterReconnect = self.fetchStatus;
+
+        self.addSensor = function(){
+            var sensors = self.settingsViewModel.settings.plugins.filamentsensorsimplified.sensors;
+            sensors.push({
+                name: ko.observable('Sensor ' + (sensors().length + 2)),
+                type: ko.observable('switch'),
+                pin: ko.observable(0),
+                power: ko.observable(0),
+                triggered: ko.observable(0),
+                g_code: ko.observable(self.settingsViewModel.settings.plugins.filamentsensorsimplified.g_code()),
+                motion_window: ko.observable(self.settingsViewModel.settings.plugins.filamentsensorsimplified.motion_window()),
+                motion_pulses_per_mm: ko.observable(self.settingsViewModel.settings.plugins.filamentsensorsimplified.motion_pulses_per_mm())
+            });
+        }
+
+        self.removeSensor = function(sensor){
+            self.settingsViewModel.settings.plugins.filamentsensorsimplified.sensors.remove(sensor);
+        }
+
         self.testSensor = function () {
             // Cleanup
             $("#filamentsensorsimplified_settings_testResult").hide().removeClass("hide alert-warning alert-error alert-info alert-success");
@@ -68,6 +114,10 @@ $(function () {
                         556: function () {
                             $("#filamentsensorsimplified_settings_testResult").addClass("alert-error");
                             self.testSensorResult('<i class="fas icon-warning-sign fa-exclamation-triangle"></i> The pin selected is power, ground or out of range pin number, choose other pin');
+                        },
+                        557: function () {
+                            $("#filamentsensorsimplified_settings_testResult").addClass("alert-warning");
+                            self.testSensorResult('<i class="fas icon-warning-sign fa-exclamation-triangle"></i> GPIO is in use in the other board mode, save the settings first.');
                         }
                     },
                     error: function () {
@@ -89,6 +139,44 @@ $(function () {
             });
         }
 
+        // Probe all pins of the selected mode in one request
+        self.scanPins = function () {
+            self.scanning(true);
+            $.ajax({
+                    url: "/api/plugin/filamentsensorsimplified",
+                    type: "post",
+                    dataType: "json",
+                    contentType: "application/json",
+                    headers: {"X-Api-Key": UI_API_KEY},
+                    data: JSON.stringify({
+                        "command": "scanPins",
+                        "mode": $("#filamentsensorsimplified_settings_gpioMode").val(),
+                        "power": $("#filamentsensorsimplified_settings_powerInput").val(),
+                        "triggered": $("#filamentsensorsimplified_settings_triggeredInput").val()
+                    }),
+                    success: function (result) {
+                        var pins = $.map(result.pins, function(probe){
+                            var state = '';
+                            if (probe.usage == 'used') {
+                                state = 'used by others';
+                            } else if (probe.usage == 'invalid') {
+                                state = 'power, ground or out of range';
+                            } else if (probe.usage == 'mode') {
+                                state = 'GPIO in use in the other board mode';
+                            } else if (probe.noFilament !== null) {
+                                state = probe.noFilament ? 'triggered' : 'filament detected';
+                            }
+                            return {pin: probe.pin, sensor: probe.sensor || '', state: state};
+                        });
+                        pins.sort(function(a, b){ return a.pin - b.pin; });
+                        self.scanResult(pins);
+                    }
+                }
+            ).always(function(){
+                self.scanning(false);
+            });
+        }
+
         self.checkWarningPullUp = function(event){
             // Which mode are we using
             var mode = parseInt($('#filamentsensorsimplified_settings_gpioMode').val(),10);
@@ -149,6 +237,7 @@ $(function () {
 
         self.onSettingsShown = function () {
             self.testSensorResult("");
+            self.scanResult([]);
             self.getDisabled();
              // Check for broken settings
             $('#filamentsensorsimplified_settings_gpioMode, #filamentsensorsimplified_settings_pinInput, #filamentsensorsimplified_settings_powerInput').off('change.fsensor').on('change.fsensor',self.checkWarningPullUp);